@@ -0,0 +1,306 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urljoin
+
+import aiohttp
+
+from metrics import BACKEND_ERRORS
+from scheduler import Overloaded
+
+
+class CompletionError(Exception):
+    """Raised when the completion endpoint reports an error."""
+
+
+class CompletionClient:
+    """A long-lived HTTP client for the completion endpoint."""
+
+    def __init__(self, endpoint, connect_timeout=5, read_timeout=120, connections=16, retries=3, retry_backoff=0.5):
+        """Initialize a CompletionClient.
+
+        :param endpoint: The URL of the completion endpoint.
+        :type endpoint: str
+        :param connect_timeout: Seconds to wait for a connection, defaults to 5.
+        :type connect_timeout: float, optional
+        :param read_timeout: Seconds to wait between reads of the response, defaults to 120.
+        :type read_timeout: float, optional
+        :param connections: The maximum number of pooled connections per host, defaults to 16.
+        :type connections: int, optional
+        :param retries: How many times a BackendPool retries a failed request, defaults to 3.
+        :type retries: int, optional
+        :param retry_backoff: Seconds to wait before the first retry, doubled on every further retry, defaults to 0.5.
+        :type retry_backoff: float, optional
+        """
+        self.endpoint = endpoint
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.connections = connections
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.session = None
+        # kept up to date by the BackendPools using this client
+        self.outstanding = 0
+        self.failures = 0
+        self.open_until = 0
+
+    async def start(self):
+        """Open the pooled session."""
+        if self.session is None:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.connections, keepalive_timeout=60)
+            timeout = aiohttp.ClientTimeout(
+                sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            self.session = aiohttp.ClientSession(
+                connector=connector, timeout=timeout)
+
+    async def close(self):
+        """Close the pooled session and its connections."""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def is_open(self, now=None):
+        """Whether requests to this endpoint are held back after repeated failures."""
+        return self.open_until > (now if now is not None else time.monotonic())
+
+    async def post(self, payload):
+        """Post a request once, retries and failing over are left to the BackendPool.
+
+        :param payload: The JSON body of the request.
+        :type payload: dict
+        :return: The response, which the caller has to release.
+        :rtype: aiohttp.ClientResponse
+        """
+        await self.start()
+        try:
+            return await self.session.post(self.endpoint, json=payload)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            BACKEND_ERRORS.inc(kind='connection')
+            raise
+
+
+async def read_events(resp):
+    """Yield the generated text of a streaming response.
+
+    :param resp: The response of a streaming generation request.
+    :type resp: aiohttp.ClientResponse
+    :raises CompletionError: If the endpoint reports an error.
+    :return: An async generator of generated text pieces.
+    :rtype: AsyncGenerator[str]
+    """
+    if resp.status >= 400:
+        raise CompletionError(await resp.text())
+    async for line in resp.content:
+        line = line.decode('utf-8').strip()
+        if not line.startswith('data:'):
+            continue
+        data = line[5:].strip()
+        if data == '[DONE]':
+            return
+        event = json.loads(data)
+        if 'error' in event:
+            raise CompletionError(event['error'])
+        yield event['text']
+
+
+class BackendPool:
+    """Spreads the requests of a character over several completion endpoints and fails over between them.
+
+    An endpoint that fails failure_threshold times in a row is left out for the
+    cooldown, unless every endpoint is. Health checks take endpoints out before
+    a request has to fail on them and bring them back once they answer again.
+    """
+
+    def __init__(self, backends, strategy='least_outstanding', failure_threshold=3, cooldown=30, health_interval=0, health_path='/health'):
+        """Initialize a BackendPool.
+
+        :param backends: The clients of the endpoints with their weights, as (client, weight) pairs.
+        :type backends: list
+        :param strategy: "least_outstanding" to pick the endpoint with the fewest running requests for its weight,
+            or "weighted" to pick at random by weight, defaults to least_outstanding.
+        :type strategy: str, optional
+        :param failure_threshold: Failures in a row after which an endpoint is left out, defaults to 3.
+        :type failure_threshold: int, optional
+        :param cooldown: Seconds a failing endpoint is left out, defaults to 30.
+        :type cooldown: float, optional
+        :param health_interval: Seconds between health checks, defaults to 0, which disables them.
+        :type health_interval: float, optional
+        :param health_path: The path requested by health checks, relative to the endpoint, defaults to /health.
+            Any answer below 500 counts as healthy.
+        :type health_path: str, optional
+        """
+        self.backends = list(backends)
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.health_interval = health_interval
+        self.health_path = health_path
+        self.health_task = None
+
+    async def start(self):
+        """Open the clients and start the health checks."""
+        for client, _ in self.backends:
+            await client.start()
+        if self.health_interval and self.health_task is None:
+            self.health_task = asyncio.create_task(self.check_health())
+
+    async def close(self):
+        """Stop the health checks, the clients are closed by their owner as they may be shared."""
+        if self.health_task is not None:
+            self.health_task.cancel()
+            self.health_task = None
+
+    def choose(self, exclude=()):
+        now = time.monotonic()
+        candidates = [i for i in self.backends if i[0] not in exclude]
+        # when every endpoint is failing, trying one is better than not answering
+        candidates = [i for i in candidates if not i[0].is_open(now)] or candidates
+        if not candidates:
+            return None
+        if self.strategy == 'weighted':
+            return random.choices([i[0] for i in candidates], [i[1] for i in candidates])[0]
+        return min(candidates, key=lambda i: ((i[0].outstanding + 1) / i[1], random.random()))[0]
+
+    def failed(self, client, reason):
+        client.failures += 1
+        if client.failures >= self.failure_threshold and not client.is_open():
+            client.open_until = time.monotonic() + self.cooldown
+            logging.warning(
+                f'{client.endpoint} failed {client.failures} times ({reason}), leaving it out for {self.cooldown}s.')
+
+    def succeeded(self, client):
+        if client.failures >= self.failure_threshold:
+            logging.info(f'{client.endpoint} is answering again.')
+        client.failures = 0
+        client.open_until = 0
+
+    async def post(self, payload):
+        """Post a request to the best endpoint, failing over to the others on connection errors and server errors.
+
+        Every endpoint is tried once per attempt, and attempts are repeated with the
+        retries and backoff of the first client.
+
+        :param payload: The JSON body of the request.
+        :type payload: dict
+        :return: The client that answered, with its outstanding count raised, and the response.
+        :rtype: tuple
+        """
+        retries, retry_backoff = self.backends[0][0].retries, self.backends[0][0].retry_backoff
+        for attempt in range(retries + 1):
+            tried = set()
+            while (client := self.choose(tried)) is not None:
+                tried.add(client)
+                last_attempt = attempt == retries and all(i[0] in tried for i in self.backends)
+                client.outstanding += 1
+                try:
+                    resp = await client.post(payload)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    client.outstanding -= 1
+                    self.failed(client, repr(e))
+                    if last_attempt:
+                        raise
+                    continue
+                except BaseException:
+                    client.outstanding -= 1
+                    raise
+                if resp.status >= 500:
+                    BACKEND_ERRORS.inc(kind='status')
+                    self.failed(client, resp.status)
+                    if not last_attempt:
+                        resp.release()
+                        client.outstanding -= 1
+                        continue
+                else:
+                    self.succeeded(client)
+                return client, resp
+            await asyncio.sleep(retry_backoff * 2 ** attempt)
+
+    @asynccontextmanager
+    async def request(self, payload):
+        client, resp = await self.post(payload)
+        try:
+            async with resp:
+                if resp.status == 429:
+                    # e.g. the coordinator shed the request of a sharded worker
+                    raise Overloaded((await resp.json(content_type=None))['error'])
+                yield resp
+        finally:
+            client.outstanding -= 1
+
+    async def complete(self, payload):
+        """Post a generation request and wait for the whole response.
+
+        :param payload: The JSON body of the request.
+        :type payload: dict
+        :raises Overloaded: If the endpoint answers that it has too many requests.
+        :return: The decoded JSON response.
+        :rtype: dict or list
+        """
+        async with self.request(payload) as resp:
+            return await resp.json(content_type=None)
+
+    async def stream(self, payload):
+        """Post a streaming generation request and yield the generated text as it arrives.
+
+        Requests fail over until an endpoint starts answering, errors while streaming are raised.
+
+        :param payload: The JSON body of the request, ``stream`` is set on a copy.
+        :type payload: dict
+        :raises CompletionError: If the endpoint reports an error.
+        :raises Overloaded: If the endpoint answers that it has too many requests.
+        :return: An async generator of generated text pieces.
+        :rtype: AsyncGenerator[str]
+        """
+        async with self.request(dict(payload, stream=True)) as resp:
+            async for text in read_events(resp):
+                yield text
+
+    async def check_health(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await asyncio.gather(*(self.check(client) for client, _ in self.backends))
+
+    async def check(self, client):
+        try:
+            async with client.session.get(urljoin(client.endpoint, self.health_path),
+                                          timeout=aiohttp.ClientTimeout(total=client.connect_timeout)) as resp:
+                healthy = resp.status < 500
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            healthy = False
+        if healthy and client.is_open():
+            self.succeeded(client)
+        elif not healthy:
+            client.failures = max(client.failures, self.failure_threshold - 1)
+            self.failed(client, 'health check')
+
+
+def pool_for(endpoints, clients, pools, config):
+    """Get the BackendPool of a list of endpoints, creating it and the clients it is missing.
+
+    :param endpoints: The URLs of the endpoints with their weights, as (url, weight) pairs.
+    :type endpoints: list
+    :param clients: The clients by URL, shared between pools.
+    :type clients: dict
+    :param pools: The pools by endpoint list.
+    :type pools: dict
+    :param config: The parsed config.yaml, its backend and balancing blocks configure new clients and pools.
+    :type config: dict
+    :return: The pool.
+    :rtype: BackendPool
+    """
+    # an endpoint listed more than once gets one client with the summed weight
+    weights = {}
+    for url, weight in endpoints:
+        weights[url] = weights.get(url, 0) + weight
+    key = tuple(weights.items())
+    if key not in pools:
+        for url in weights:
+            if url not in clients:
+                clients[url] = CompletionClient(url, **config['backend'])
+        pools[key] = BackendPool([(clients[url], weight) for url, weight in weights.items()],
+                                 **config['balancing'])
+    return pools[key]
@@ -0,0 +1,258 @@
+"""Offline benchmarks for the context and reply pipeline.
+
+Runs the real functions on synthetic Discord messages and the prompts in config/,
+sweeping history length, message length, lorebook size and token budget, and
+reports the time per call and peak memory. Results are written as JSON so runs
+on different commits can be compared with ``--compare``.
+
+    python bench.py --output before.json
+    python bench.py --output after.json --compare before.json
+"""
+import argparse
+import asyncio
+import glob
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+
+import utils
+from bot import DiscordBot
+from character import load_character
+from fakediscord import FakeChannel, FakeClient, FakeUser
+
+SWEEPS = {
+    'full': {
+        'history': [10, 40, 200],
+        'words': [8, 64],
+        'lorebook': [0, 1000, 5000],
+        'budget': [924, 8192, 32768],
+        'tokens': [1024, 8192, 32768],
+        'spam_history': [40, 200, 1000],
+        'spam_words': [8, 64, 512],
+    },
+    'quick': {
+        'history': [40],
+        'words': [16],
+        'lorebook': [0, 1000],
+        'budget': [924, 8192],
+        'tokens': [1024, 8192],
+        'spam_history': [40, 200],
+        'spam_words': [16, 256],
+    },
+}
+
+
+class Corpus:
+    """Synthetic chat text made from the words of the character prompts."""
+
+    def __init__(self, characters, seed=0):
+        self.random = random.Random(seed)
+        self.words = [word for character in characters
+                      for word in character.config['prompt'].split()]
+        self.authors = [FakeUser(f'user{i}') for i in range(8)]
+
+    def sentence(self, words):
+        return ' '.join(self.random.choice(self.words) for _ in range(words))
+
+    def channel(self, client, history, words, spam_ratio=0.1):
+        channel = FakeChannel(client)
+        for _ in range(history):
+            if channel.messages and self.random.random() < spam_ratio:
+                content = self.random.choice(channel.messages).content
+            else:
+                content = self.sentence(self.random.randint(1, words * 2))
+            channel.post(content, self.random.choice(self.authors))
+        return channel
+
+    def lorebook(self, size):
+        return utils.Lorebook(utils.ContextEntry(keys=[self.random.choice(self.words).lower()], text=self.sentence(20), insertion_order=100)
+                              for _ in range(size))
+
+
+def clear_caches():
+    utils.clear_encode_cache()
+
+
+def measure(fn, repeat, cold):
+    """Time a function and record the peak memory of one call.
+
+    :param fn: The function to measure, called without arguments.
+    :type fn: callable
+    :param repeat: How many timed calls to make.
+    :type repeat: int
+    :param cold: Whether the tokenization cache is cleared before every call.
+    :type cold: bool
+    :return: The timings in seconds and the peak memory in bytes.
+    :rtype: dict
+    """
+    if not cold:
+        fn()
+    times = []
+    for _ in range(repeat):
+        if cold:
+            clear_caches()
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    if cold:
+        clear_caches()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'median': statistics.median(times),
+        'min': min(times),
+        'mean': statistics.mean(times),
+        'peak_memory': peak,
+    }
+
+
+class Benchmarks:
+    def __init__(self, sweep, repeat):
+        self.sweep = sweep
+        self.repeat = repeat
+        self.loop = asyncio.new_event_loop()
+        self.client = FakeClient()
+        self.bot = DiscordBot(self.client)
+        self.characters = [load_character(os.path.basename(path)[:-5])
+                           for path in sorted(glob.glob(os.path.dirname(os.path.abspath(__file__))+"/config/*.json"))]
+        self.corpus = Corpus(self.characters)
+        self.results = []
+
+    def run(self, name, params, fn):
+        for cold in (True, False):
+            result = measure(fn, self.repeat, cold)
+            self.results.append(dict(name=name, params=params,
+                                     cache='cold' if cold else 'warm', **result))
+            print(f"{name:<16} {json.dumps(params):<64} {'cold' if cold else 'warm'} "
+                  f"{result['median'] * 1000:9.2f} ms {result['peak_memory'] / 1024:9.0f} KiB")
+
+    def conversation(self, history, words):
+        channel = self.corpus.channel(self.client, history, words, spam_ratio=0)
+        return '\n'.join(f'{m.author.name}: {m.content}' for m in channel.messages)
+
+    def bench_context(self):
+        for history, words, lorebook, budget in itertools.product(self.sweep['history'], self.sweep['words'], self.sweep['lorebook'], self.sweep['budget']):
+            conversation = self.conversation(history, words)
+            lore = self.corpus.lorebook(lorebook)
+            characters = itertools.cycle(self.characters)
+
+            def build():
+                character = next(characters)
+                contextmgr = utils.ContextPreprocessor(budget)
+                contextmgr.add_entry(utils.ContextEntry(text=character.config['prompt'], suffix='\n', reserved_tokens=512, insertion_order=1000,
+                                                        insertion_position=-1, insertion_type=6, forced_activation=True))
+                contextmgr.add_entry(utils.ContextEntry(text=conversation, suffix=f'\n{character.name}:', reserved_tokens=512, insertion_order=0,
+                                                        insertion_position=-1, trim_direction=0, trim_type=7, insertion_type=6,
+                                                        forced_activation=True, cascading_activation=True))
+                if lore:
+                    contextmgr.add_lorebook(lore)
+                contextmgr.context(budget)
+            self.run('context', dict(history=history, words=words,
+                     lorebook=lorebook, budget=budget), build)
+
+    def bench_trim(self):
+        for length, budget in itertools.product(self.sweep['tokens'], self.sweep['budget']):
+            if budget >= length:
+                continue
+            text = self.corpus.sentence(length)
+            tokens = utils.encode(text)[:length]
+            for fn, trim_dir in itertools.product((utils.trim_newlines, utils.trim_sentences, utils.trim_tokens), (utils.TRIM_DIR_TOP, utils.TRIM_DIR_BOTTOM)):
+                self.run(fn.__name__, dict(tokens=length, budget=budget, direction=trim_dir),
+                         lambda: fn(list(tokens), trim_dir, budget))
+
+    def bench_anti_spam(self):
+        for history, words in itertools.product(self.sweep['spam_history'], self.sweep['spam_words']):
+            messages = self.corpus.channel(
+                self.client, history, words).messages
+            self.run('anti_spam', dict(history=history, words=words),
+                     lambda: utils.anti_spam(messages))
+
+    def bench_get_msg_ctx(self):
+        for words in self.sweep['words']:
+            channel = self.corpus.channel(self.client, 40, words)
+
+            def cold_channel():
+                self.bot.buffers.clear()
+                self.loop.run_until_complete(self.bot.get_msg_ctx(channel))
+            self.run('get_msg_ctx', dict(words=words,
+                     buffer='cold'), cold_channel)
+            self.run('get_msg_ctx', dict(words=words, buffer='warm'),
+                     lambda: self.loop.run_until_complete(self.bot.get_msg_ctx(channel)))
+
+    def bench_get_respond(self):
+        character = self.characters[0]
+        for lines in (2, 20, 200):
+            conversation = self.conversation(lines, 16)
+            response = [
+                {'generated_text': f'{conversation}\n{character.name}: {self.corpus.sentence(16)}\nuser0: {self.corpus.sentence(16)}'}]
+            self.run('get_respond', dict(lines=lines),
+                     lambda: self.bot.get_respond(response, character))
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+    }
+
+
+def compare(results, baseline):
+    """Print the change in median time against a previous run.
+
+    :param results: The results of this run.
+    :type results: list
+    :param baseline: The results of the previous run.
+    :type baseline: list
+    """
+    old = {(i['name'], json.dumps(i['params'], sort_keys=True), i['cache']): i for i in baseline}
+    print(f"\n{'benchmark':<16} {'params':<64} {'cache':<5} {'before':>10} {'after':>10} {'change':>8}")
+    for i in results:
+        before = old.get(
+            (i['name'], json.dumps(i['params'], sort_keys=True), i['cache']))
+        if before is None:
+            continue
+        change = i['median'] / before['median'] - 1 if before['median'] else 0
+        print(f"{i['name']:<16} {json.dumps(i['params']):<64} {i['cache']:<5} "
+              f"{before['median'] * 1000:8.2f}ms {i['median'] * 1000:8.2f}ms {change:+8.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sweep', choices=SWEEPS, default='full')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='*', default=None,
+                        help='benchmarks to run: context trim anti_spam get_msg_ctx get_respond')
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--compare', default=None,
+                        help='a previous output file to compare against')
+    args = parser.parse_args()
+
+    benchmarks = Benchmarks(SWEEPS[args.sweep], args.repeat)
+    for name in args.only or ['context', 'trim', 'anti_spam', 'get_msg_ctx', 'get_respond']:
+        getattr(benchmarks, f'bench_{name}')()
+
+    with open(args.output, 'w') as f:
+        json.dump({'meta': metadata(), 'results': benchmarks.results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(benchmarks.results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,77 +1,458 @@
 import os
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import aclosing, nullcontext
 from dotenv import load_dotenv
 import logging
-import json
 import re
-import aiohttp
 import yaml
+import aiohttp
+from aiohttp import web
 
 import discord
 from discord.ext import commands
 
-from utils import anti_spam, ContextPreprocessor, ContextEntry
+from utils import ContextPreprocessor, ContextEntry, StableContext, count_tokens, encode, encode_cache_size, get_tokenizer, set_tokenizer
+from history import BufferedMessage, MessageBuffer, TranscriptStore
+from backend import CompletionError, pool_for
+from character import character_names, load_character, TriggerMatcher
+from workers import WorkerPool
+from metrics import resident_memory, REGISTRY, STAGES, STAGE_SECONDS, CONTEXT_TOKENS, TRIGGERS, COALESCED, REPLIES, BACKEND_ERRORS, REPLY_TOKENS, DISCARDED_TOKENS, SHED
+from scheduler import Scheduler, Overloaded, PRIORITY_DIRECT, PRIORITY_NICKNAME
 
 load_dotenv()
 
+CONTEXT_BUDGET = 924
+TRANSCRIPT_FLUSH_INTERVAL = 5
+
 
 class DiscordBot(commands.Cog):
     def __init__(self, client):
         self.client = client
         with open(os.path.dirname(os.path.abspath(__file__))+"/config.yaml", "r") as f:
             self.config = yaml.safe_load(f)
-        with open(os.path.dirname(os.path.abspath(__file__))+f"/config/{os.getenv('CONFIG', self.config['config'])}.json", encoding="utf-8") as f:
-            self.char_config = json.load(f)
+        self.characters = {}
+        for key in character_names(self.config):
+            self.characters[key] = load_character(key)
+        # guild or channel IDs mapped to the keys of the characters answering there
+        self.routes = self.config['routes'] or {}
+        self.matcher = TriggerMatcher(self.characters.values())
+        # IDs of recently sent replies mapped to the character that sent them
+        self.sent = OrderedDict()
+        # the tokenizer is shared, so the first character's one is used for all of them
+        tokenizers = {c.config.get('tokenizer', 'gpt2') for c in self.characters.values()}
+        if len(tokenizers) > 1:
+            logging.warning(f'Characters use different tokenizers {tokenizers}, using the first one.')
+        set_tokenizer(next(iter(self.characters.values())).config.get('tokenizer', 'gpt2'))
+        # per-channel buffers of recent messages, filled from history on first use
+        self.buffers = {}
+        # buffers of cold channels while they are filled, events update them but replies wait for the fill
+        self.filling = {}
+        self.fills = {}
+        self.history_limit = int(os.getenv('HISTORY_LIMIT', self.config['history_limit']))
+        self.spam_threshold = float(os.getenv('SPAM_THRESHOLD', self.config['spam_threshold']))
+        # per-channel and character reply tasks, a newer trigger replaces the pending one
+        self.pending = {}
+        self.debounce = float(os.getenv('REPLY_DEBOUNCE', self.config['reply_debounce']))
+        # "stable" keeps the start of the context fixed between turns so the backend can reuse its cache
+        self.context_mode = os.getenv('CONTEXT_MODE', self.config['context_mode']).lower()
+        # context building runs here instead of on the event loop
+        self.workers = WorkerPool(**self.config['workers'])
+        # the buffers are kept on disk too if a path is set, so a restart only fetches newer messages,
+        # token IDs only help when lines are encoded in this process, worker processes tokenize on their own
+        transcripts = os.getenv('TRANSCRIPTS') or self.config['transcripts']
+        self.transcripts = TranscriptStore(transcripts, self.history_limit,
+                                           tokens=self.context_mode == 'stable' and not self.workers.processes) if transcripts else None
+        self.flush_task = None
+        # per-channel and character StableContext windows
+        self.windows = {}
+        self.stream = os.getenv('STREAM', self.config['stream']).lower() == 'on'
+        self.stream_edit_interval = float(self.config['stream_edit_interval'])
+        # turns of the most recent speakers end generation, so the backend does not write lines nobody sees
+        self.stop_count = int(self.config['stop_sequences'])
+        self.max_new_tokens = int(os.getenv('MAX_NEW_TOKENS', self.config['max_new_tokens']))
+        self.adaptive_max_tokens = os.getenv('ADAPTIVE_MAX_TOKENS', self.config['adaptive_max_tokens']).lower() == 'on'
+        # clients by endpoint URL and pools by endpoint list, both shared between characters
+        self.backends = {}
+        self.pools = {}
+        proxy = self.proxy = os.getenv('BACKEND_PROXY')
+        for character in self.characters.values():
+            if proxy:
+                # a sharded worker, the coordinator balances the requests of all workers and retries them
+                character.backend = pool_for([(f'{proxy}/completion/{character.key}', 1)], self.backends, self.pools,
+                                             dict(self.config, backend=dict(self.config['backend'], retries=0)))
+            else:
+                self.connect(character, character.get_endpoints(
+                    os.getenv('ENDPOINT', self.config['endpoint'])))
+        # generation requests of all characters wait here for a free slot, a sharded worker's wait at the coordinator
+        self.scheduler = None if proxy else Scheduler(**self.config['scheduler'])
+        self.metrics_port = os.getenv('METRICS_PORT', self.config['metrics_port'])
+        self.metrics_runner = None
+
+    async def cog_load(self):
+        for pool in self.pools.values():
+            await pool.start()
+        self.workers.start()
+        if self.transcripts is not None:
+            self.flush_task = asyncio.create_task(self.flush_transcripts())
+        if self.metrics_port:
+            app = web.Application()
+            app.router.add_get('/metrics', self.serve_metrics)
+            self.metrics_runner = web.AppRunner(app)
+            await self.metrics_runner.setup()
+            await web.TCPSite(self.metrics_runner, '0.0.0.0', int(self.metrics_port)).start()
+
+    async def cog_unload(self):
+        for task in self.pending.values():
+            task.cancel()
+        for task in self.fills.values():
+            task.cancel()
+        for pool in self.pools.values():
+            await pool.close()
+        for backend in self.backends.values():
+            await backend.close()
+        self.workers.close()
+        if self.transcripts is not None:
+            self.flush_task.cancel()
+            await asyncio.to_thread(self.transcripts.close)
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+
+    async def flush_transcripts(self):
+        while True:
+            await asyncio.sleep(TRANSCRIPT_FLUSH_INTERVAL)
+            try:
+                await asyncio.to_thread(self.transcripts.flush)
+            except Exception:
+                logging.exception('Could not write the transcripts.')
+
+    def connect(self, character, endpoints):
+        character.backend = pool_for(endpoints, self.backends, self.pools, self.config)
+
+    async def serve_metrics(self, request):
+        return web.Response(text=REGISTRY.render(), content_type='text/plain')
 
     @commands.command()
     async def toggle(self, ctx):
         pass
 
+    @commands.command()
+    @commands.is_owner()
+    async def metrics(self, ctx):
+        def ms(value):
+            return f'{value * 1000:>7.0f}' if value != float('inf') else '    inf'
+        lines = [f'{"stage":<10} {"count":>6} {"p50 ms":>7} {"p95 ms":>7} {"p99 ms":>7}']
+        for stage in STAGES:
+            if STAGE_SECONDS.count(stage=stage):
+                lines.append(f'{stage:<10} {STAGE_SECONDS.count(stage=stage):>6} {ms(STAGE_SECONDS.quantile(0.5, stage=stage))} '
+                             f'{ms(STAGE_SECONDS.quantile(0.95, stage=stage))} {ms(STAGE_SECONDS.quantile(0.99, stage=stage))}')
+        for counter in (TRIGGERS, COALESCED, REPLIES, DISCARDED_TOKENS, SHED, BACKEND_ERRORS):
+            lines.append(f'{counter.name} {sum(counter.values.values())}')
+        if self.scheduler is not None:
+            lines.append(f'generating {self.scheduler.active}/{self.scheduler.concurrency}, waiting {self.scheduler.waiting}')
+        elif self.proxy:
+            # a sharded worker's requests wait at the coordinator, which also counts their queueing, shedding and backend errors
+            try:
+                async with aiohttp.ClientSession() as session, session.get(f'{self.proxy}/health') as resp:
+                    health = await resp.json()
+                lines.append(f'generating {health["active"]}/{health["concurrency"]}, waiting {health["waiting"]} at the coordinator')
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                lines.append('the coordinator does not answer')
+        if CONTEXT_TOKENS.count():
+            lines.append(f'context tokens p50 <= {CONTEXT_TOKENS.quantile(0.5)}, p95 <= {CONTEXT_TOKENS.quantile(0.95)}')
+        await ctx.send('```\n' + '\n'.join(lines) + '\n```')
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # load the tokenizer off the event loop once the gateway is up, instead of on the first reply
+        started = time.monotonic()
+        await asyncio.to_thread(get_tokenizer)
+        if self.workers.processes:
+            # worker processes load their own copy
+            await asyncio.gather(*(self.workers.run(encode, '') for _ in range(self.workers.size)))
+        logging.info(
+            f'Tokenizer ready in {time.monotonic() - started:.2f}s.')
+        logging.info(self.memory_report().replace('\n', ', '))
+
+    def memory_report(self):
+        resident, peak = resident_memory()
+        mib = 1024 * 1024
+        lines = [f'resident {resident / mib:.0f} MiB, peak {peak / mib:.0f} MiB' if resident is not None else f'peak {peak / mib:.0f} MiB',
+                 f'guilds {len(self.client.guilds)}, cached users {len(self.client.users)}, '
+                 f'cached messages {len(self.client.cached_messages)}',
+                 f'buffered channels {len(self.buffers)}, messages {sum(len(i) for i in self.buffers.values())}',
+                 f'encode cache {encode_cache_size()} tokens']
+        return '\n'.join(lines)
+
+    @commands.command()
+    @commands.is_owner()
+    async def memory(self, ctx):
+        await ctx.send('```\n' + self.memory_report() + '\n```')
+
     @commands.Cog.listener()
     async def on_message(self, message):
+        buffer = self.buffer_of(message.channel.id)
+        if buffer is not None:
+            cleaned = self.clean_message(message)
+            buffer.append(cleaned)
+            if self.transcripts is not None:
+                self.transcripts.add(message.channel.id, cleaned)
         if message.author == self.client.user or message.content.startswith(os.getenv("DISCORD_PREFIX", self.config['discord_prefix'])):
             return
-        if self.client.user.mentioned_in(message) or any(nickname.lower() in message.content.lower() for nickname in self.char_config['client_args']['nicknames']) or isinstance(message.channel, discord.channel.DMChannel):
-            conversation = await self.get_msg_ctx(message.channel)
-            await self.respond(conversation, message)
+        routed = self.route(message.channel)
+        characters = [c for c in self.matcher.match(message.content) if c in routed]
+        direct = self.client.user.mentioned_in(message) or isinstance(message.channel, discord.channel.DMChannel)
+        if not characters and routed and direct:
+            characters = routed[:1]
+        priority = PRIORITY_DIRECT if direct else PRIORITY_NICKNAME
+        for character in characters:
+            TRIGGERS.inc(character=character.key)
+            self.schedule_reply(message, character, priority)
 
-    async def respond(self, conversation, message):
-        async with message.channel.typing():
-            conversation = await self.build_ctx(conversation)
-            response = await self.enma_respond(conversation)
-            response = self.get_respond(response)
-            await message.channel.send(response)
+    def route(self, channel):
+        keys = self.routes.get(channel.id)
+        if keys is None and getattr(channel, 'guild', None) is not None:
+            keys = self.routes.get(channel.guild.id)
+        if keys is None:
+            return list(self.characters.values())
+        return [self.characters[key] for key in keys if key in self.characters]
 
-    def get_respond(self, response):
-        count = -1
-        while True:
+    def schedule_reply(self, message, character, priority=PRIORITY_DIRECT):
+        # supersede the pending reply so only the freshest context is answered
+        key = (message.channel.id, character.key)
+        task = self.pending.get(key)
+        if task is not None and not task.done():
+            task.cancel()
+            COALESCED.inc()
+        task = asyncio.create_task(self.debounced_reply(message, character, priority))
+        task.add_done_callback(lambda t: self.reply_done(key, t))
+        self.pending[key] = task
+
+    def reply_done(self, key, task):
+        if self.pending.get(key) is task:
+            del self.pending[key]
+        if not task.cancelled() and task.exception() is not None:
+            logging.error('Reply failed.', exc_info=task.exception())
+
+    async def debounced_reply(self, message, character, priority=PRIORITY_DIRECT):
+        # replies cancelled by a newer trigger are not observed
+        started = time.perf_counter()
+        await asyncio.sleep(self.debounce)
+        conversation = await self.get_msg_ctx(message.channel)
+        await self.respond(conversation, message, character, priority)
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage='reply')
+
+    def remember_reply(self, reply, character):
+        REPLIES.inc(character=character.key)
+        self.sent[reply.id] = character
+        while len(self.sent) > 1000:
+            self.sent.popitem(last=False)
+        # the gateway may have delivered the reply before send() returned
+        buffer = self.buffer_of(reply.channel.id)
+        if buffer is not None and reply.id in buffer:
+            cleaned = self.clean_message(reply)
+            buffer.update(cleaned)
+            if self.transcripts is not None:
+                self.transcripts.update(reply.channel.id, cleaned)
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload):
+        # raw, so edits reach the buffers without discord.py's message cache
+        buffer = self.buffer_of(payload.channel_id)
+        if buffer is None:
+            return
+        cleaned = self.clean_message(payload.message)
+        buffer.update(cleaned)
+        if self.transcripts is not None:
+            self.transcripts.update(payload.channel_id, cleaned)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+        buffer = self.buffer_of(payload.channel_id)
+        if buffer is None:
+            return
+        buffer.remove(payload.message_id)
+        if self.transcripts is not None:
+            self.transcripts.remove(payload.channel_id, payload.message_id)
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload):
+        buffer = self.buffer_of(payload.channel_id)
+        if buffer is None:
+            return
+        for message_id in payload.message_ids:
+            buffer.remove(message_id)
+            if self.transcripts is not None:
+                self.transcripts.remove(payload.channel_id, message_id)
+
+    async def respond(self, conversation, message, character, priority=PRIORITY_DIRECT):
+        async with message.channel.typing():
+            with STAGE_SECONDS.time(stage='build_ctx'):
+                gen = await self.build_request(conversation, message.channel, character)
+            guild = getattr(message.channel, 'guild', None)
             try:
-                resp = response[0]['generated_text'].splitlines()[count]
-                if resp.startswith(self.char_config['name']):
-                    return resp.replace(self.char_config['name'] + ':', '')
-                else:
-                    count = count - 1
-            except KeyError:
-                return 'error: ' + response['error']
+                async with self.slot(gen, guild and guild.id, message.channel.id, priority):
+                    if self.stream:
+                        return await self.stream_respond(gen, message, character)
+                    with STAGE_SECONDS.time(stage='generate'):
+                        response = await self.enma_respond(gen, character)
+            except Overloaded as e:
+                logging.warning(f'Dropped the reply of {character.name} in {message.channel.id}: {e}')
+                return
+            response, discarded = self.get_respond(response, character, gen['prompt'])
+            if not response.strip():
+                logging.info(f'{character.name} generated no reply.')
+                await self.record_length(character, discarded=discarded)
+                return
+            # a reply that is already being sent is not cut off by a newer trigger, nor left unrecorded
+            task = asyncio.create_task(self.send_reply(message, character, response, discarded))
+            try:
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                await asyncio.wait([task])
+                raise
+
+    async def send_reply(self, message, character, response, discarded=''):
+        with STAGE_SECONDS.time(stage='send'):
+            reply = await message.channel.send(response)
+        self.remember_reply(reply, character)
+        await self.record_length(character, '' if response.startswith('error: ') else response, discarded)
+
+    def slot(self, gen, guild, channel, priority):
+        if self.scheduler is None:
+            # the coordinator queues the requests of all workers, so it is told where this one comes from
+            gen['scheduling'] = {'guild': guild, 'channel': channel, 'priority': priority}
+            return nullcontext()
+        return self.scheduler.slot(guild, channel, priority)
 
-    async def enma_respond(self, prompt):
-        gen = self.char_config['model_provider']['gensettings']
+    async def record_length(self, character, response='', discarded=''):
+        if not response and not discarded:
+            return
+        length, discarded = await self.workers.run(count_tokens, response, discarded)
+        if response:
+            character.reply_tokens.append(length)
+            REPLY_TOKENS.observe(length)
+        if discarded:
+            DISCARDED_TOKENS.inc(discarded)
+
+    async def stream_respond(self, gen, message, character):
+        sending = asyncio.Event()
+        task = asyncio.create_task(self.stream_reply(gen, message, character, sending))
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if sending.is_set():
+                # the reply is already showing, finish it instead of leaving it cut off
+                await asyncio.wait([task])
+            else:
+                task.cancel()
+            raise
+
+    async def stream_reply(self, gen, message, character, sending):
+        text = line = shown = ''
+        reply = None
+        last_edit = 0
+        started = time.perf_counter()
+        try:
+            async with aclosing(character.backend.stream(gen)) as stream:
+                async for piece in stream:
+                    text += piece
+                    # the prompt ends with the character's name, so its turn ends at the first newline
+                    line, turn_ended, _ = text.partition('\n')
+                    if not line.strip():
+                        if turn_ended:
+                            break
+                        continue
+                    if reply is None:
+                        sending.set()
+                        reply = await message.channel.send(line)
+                        STAGE_SECONDS.observe(time.perf_counter() - started, stage='first_text')
+                        self.remember_reply(reply, character)
+                        shown, last_edit = line, time.monotonic()
+                    elif time.monotonic() - last_edit >= self.stream_edit_interval:
+                        await reply.edit(content=line)
+                        shown, last_edit = line, time.monotonic()
+                    if turn_ended:
+                        break
+        except CompletionError as e:
+            BACKEND_ERRORS.inc(kind='response')
+            if reply is None:
+                line = 'error: ' + str(e)
+        else:
+            if line.strip():
+                await self.record_length(character, line)
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage='generate')
+        if reply is None:
+            if line.strip():
+                sending.set()
+                reply = await message.channel.send(line)
+                self.remember_reply(reply, character)
+        elif shown != line:
+            await reply.edit(content=line)
+
+    def get_respond(self, response, character, prompt=None):
+        try:
+            text = response[0]['generated_text']
+        except KeyError:
+            BACKEND_ERRORS.inc(kind='response')
+            return 'error: ' + response['error'], ''
+        if prompt is not None and text.startswith(prompt):
+            text = text[len(prompt):]
+        else:
+            # the prompt did not come back as sent, take the character's last turn
+            turns = [line for line in text.splitlines() if line.startswith(character.name + ':')]
+            text = turns[-1][len(character.name) + 1:] if turns else ''
+        # the prompt ends with the character's name, so its turn ends at the first newline,
+        # the rest is counted off the event loop as discarded tokens
+        text, _, rest = text.partition('\n')
+        return text, rest if rest.strip() else ''
+
+    def gensettings(self, prompt, character, prompt_tokens=None, cache_key=None, stop=None):
+        gen = dict(character.config['model_provider']['gensettings'])
         gen['prompt'] = prompt
+        gen['max_new_tokens'] = character.max_new_tokens(self.max_new_tokens, self.adaptive_max_tokens)
+        if stop:
+            gen['stop_sequences'] = stop
+        if prompt_tokens is not None and character.config['model_provider'].get('prefix_cache'):
+            # the server can skip prefill for the tokens it already has cached under this key
+            gen['prompt_tokens'] = prompt_tokens
+            gen['cache_prompt'] = True
+            gen['cache_key'] = cache_key
+        return gen
+
+    async def enma_respond(self, gen, character):
+        return await character.backend.complete(gen)
 
-        endpoint = self.char_config['model_provider']['endpoint']
-        has_endpoint = os.getenv('ENDPOINT', self.config['endpoint'])
-        if has_endpoint:
-            endpoint = f"http://{has_endpoint}:8000/completion"
-        if self.char_config['model_provider']['endpoint'] != "http://0.0.0.0:8000/completion":
-            endpoint = self.char_config['model_provider']['endpoint']
+    def turn_stops(self, conversation, character):
+        # the character's own name too, the model may go on to its next turn
+        speakers = dict.fromkeys([character.name] + [message.line.split(':', 1)[0] for message in reversed(conversation)])
+        return [f'\n{name}:' for name in speakers][:self.stop_count]
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(endpoint, json=gen) as resp:
-                return await resp.json()
+    async def build_request(self, conversation, channel, character):
+        stop = self.turn_stops(conversation, character)
+        if self.context_mode == 'stable':
+            built = await self.build_stable_ctx(conversation, channel, character)
+            if built is not None:
+                prompt, tokens = built
+                CONTEXT_TOKENS.observe(len(tokens))
+                return self.gensettings(prompt, character, tokens, f'{channel.id}:{character.key}', stop)
+        prompt = await self.build_ctx('\n'.join(message.line for message in conversation), character)
+        return self.gensettings(prompt, character, stop=stop)
 
-    async def build_ctx(self, conversation):
-        contextmgr = ContextPreprocessor(924)
+    async def build_stable_ctx(self, conversation, channel, character):
+        key = (channel.id, character.key)
+        if key not in self.windows:
+            self.windows[key] = StableContext(
+                CONTEXT_BUDGET, self.config['drop_ratio'])
+        # the lorebook is activated on the worker too, it can have thousands of keys
+        return await self.windows[key].build_async(character.config['prompt'] + '\n', [(message.id, message.line) for message in conversation],
+                                                   f'\n{character.name}:', self.workers, character.lorebook or None)
 
-        prompt = self.char_config['prompt']
+    async def build_ctx(self, conversation, character, budget=CONTEXT_BUDGET):
+        contextmgr = ContextPreprocessor(budget)
+
+        prompt = character.config['prompt']
         prompt_entry = ContextEntry(
             text=prompt,
             prefix='',
@@ -84,41 +465,84 @@ class DiscordBot(commands.Cog):
             cascading_activation=False
         )
         contextmgr.add_entry(prompt_entry)
+        if character.lorebook:
+            contextmgr.add_lorebook(character.lorebook)
 
         # conversation
         conversation_entry = ContextEntry(
             text=conversation,
             prefix='',
-            suffix=f'\n{self.char_config["name"]}:',
+            suffix=f'\n{character.name}:',
             reserved_tokens=512,
             insertion_order=0,
             insertion_position=-1,
             trim_direction=0,
-            trim_type=7,
+            # whole lines, so the newest messages and the turn suffix are what is kept
+            trim_type=3,
             insertion_type=6,
             forced_activation=True,
-            cascading_activation=False
+            cascading_activation=True
         )
         contextmgr.add_entry(conversation_entry)
 
-        return contextmgr.context(924)
+        context = await contextmgr.context_async(budget, self.workers)
+        CONTEXT_TOKENS.observe(contextmgr.tokens_used)
+        return context
+
+    def clean_message(self, message):
+        line = None
+        if not message.embeds and message.content:
+            content = re.sub(r'\<[^>]*\>', '', message.content)
+            if content != '':
+                if message.author.name in [self.client.user.name, self.client.user.display_name, self.client.user.display_name]:
+                    character = self.sent.get(message.id) or (self.route(message.channel) or list(self.characters.values()))[0]
+                    line = f'{character.name}: {content}'
+                else:
+                    line = f'{message.author.name}: {content}'
+        return BufferedMessage(message.id, message.author.name, message.content, line)
+
+    def buffer_of(self, channel_id):
+        buffer = self.buffers.get(channel_id)
+        return buffer if buffer is not None else self.filling.get(channel_id)
 
     async def get_msg_ctx(self, channel):
-        messages = [message async for message in channel.history(limit=40)]
-        messages, to_remove = anti_spam(messages)
-        if to_remove:
-            logging.info(f'Removed {to_remove} messages from the context.')
-        chain = []
-        for message in reversed(messages):
-            if not message.embeds and message.content:
-                content = re.sub(r'\<[^>]*\>', '', message.content)
-                if content != '':
-                    if message.author.name in [self.client.user.name, self.client.user.display_name, self.client.user.display_name]:
-                        chain.append(f'{self.char_config["name"]}: {content}')
-                    else:
-                        chain.append(f'{message.author.name}: {content}')
-                continue
-        return '\n'.join(chain)
+        buffer = self.buffers.get(channel.id)
+        if buffer is None:
+            # one fill per cold channel, every reply waits for it and a cancelled reply does not cancel it
+            task = self.fills.get(channel.id)
+            if task is None:
+                task = self.fills[channel.id] = asyncio.create_task(self.fill_buffer(channel))
+                task.add_done_callback(lambda t: self.fills.pop(channel.id, None))
+            buffer = await asyncio.shield(task)
+        # the buffer marks near-duplicates of newer messages as they arrive
+        if buffer.spam.duplicates:
+            logging.info(f'Removed {len(buffer.spam.duplicates)} messages from the context.')
+        return [message for message in buffer.without_spam() if message.line is not None]
+
+    async def fill_buffer(self, channel):
+        # cold channel, fill the buffer from the stored transcript and the history since once
+        buffer = self.filling[channel.id] = MessageBuffer(self.history_limit, self.spam_threshold)
+        try:
+            last = None
+            if self.transcripts is not None:
+                stored = await asyncio.to_thread(self.transcripts.load, channel.id)
+                buffer.extend(stored)
+                last = stored[-1].id if stored else None
+            if last is None or getattr(channel, 'last_message_id', None) != last:
+                fetched = []
+                with STAGE_SECONDS.time(stage='history'):
+                    async for message in channel.history(limit=self.history_limit):
+                        if last is not None and message.id <= last:
+                            break
+                        fetched.append(self.clean_message(message))
+                buffer.extend(fetched)
+                if self.transcripts is not None:
+                    for message in fetched:
+                        self.transcripts.add(channel.id, message)
+            self.buffers[channel.id] = buffer
+            return buffer
+        finally:
+            del self.filling[channel.id]
 
 
 async def setup(client):
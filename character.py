@@ -0,0 +1,147 @@
+import os
+import json
+import re
+from collections import deque
+
+from utils import ContextEntry, Lorebook, register_lorebook
+
+DEFAULT_ENDPOINT = "http://0.0.0.0:8000/completion"
+
+# replies seen before the adaptive generation limit kicks in, and the lowest it goes
+ADAPT_AFTER = 20
+MIN_NEW_TOKENS = 16
+
+
+def character_names(config):
+    """Get the characters hosted by this process.
+
+    The CONFIG env var or the config key holds one character or several, as a
+    comma separated string or a list.
+
+    :param config: The parsed config.yaml.
+    :type config: dict
+    :return: The names of the character config files, without extension.
+    :rtype: list
+    """
+    names = os.getenv('CONFIG', config['config'])
+    if isinstance(names, str):
+        names = names.split(',')
+    return [name.strip() for name in names if name.strip()]
+
+
+def load_character(key):
+    """Load a character from config/<key>.json.
+
+    :param key: The name of the character config file, without extension.
+    :type key: str
+    :return: The loaded character.
+    :rtype: Character
+    """
+    with open(os.path.dirname(os.path.abspath(__file__))+f"/config/{key}.json", encoding="utf-8") as f:
+        return Character(key, json.load(f))
+
+
+class Character:
+    """A character hosted by the bot."""
+
+    def __init__(self, key, config):
+        """Initialize a Character.
+
+        :param key: The name of the character config file, used in routes.
+        :type key: str
+        :param config: The parsed character config.
+        :type config: dict
+        """
+        self.key = key
+        self.config = config
+        self.name = config['name']
+        self.nicknames = config['client_args']['nicknames']
+        # world info activated by keys in the conversation, indexed once here and in every worker process
+        self.lorebook = register_lorebook(key, Lorebook(ContextEntry(**entry)
+                                                        for entry in config.get('lorebook', [])))
+        self.backend = None
+        # token lengths of recent replies, for the adaptive generation limit
+        self.reply_tokens = deque(maxlen=200)
+
+    def max_new_tokens(self, default, adaptive=False):
+        """Get how many tokens the backend may generate for a reply.
+
+        The limit is max_new_tokens in the character's gensettings, or the default.
+        When adaptive, it is lowered to one and a half times the 95th percentile of
+        the character's recent reply lengths, as everything after its turn is thrown away.
+
+        :param default: The limit for characters that do not set one.
+        :type default: int
+        :param adaptive: Whether to adapt the limit to recent replies, defaults to False.
+        :type adaptive: bool, optional
+        :return: The generation limit in tokens.
+        :rtype: int
+        """
+        limit = self.config['model_provider']['gensettings'].get('max_new_tokens', default)
+        if adaptive and len(self.reply_tokens) >= ADAPT_AFTER:
+            lengths = sorted(self.reply_tokens)
+            longest = lengths[int(len(lengths) * 0.95)]
+            limit = min(limit, max(MIN_NEW_TOKENS, int(longest * 1.5)))
+        return limit
+
+    def get_endpoints(self, default_hosts):
+        """Resolve the completion endpoints of the character.
+
+        The endpoint in the character's model_provider is a URL, or a list of URLs or
+        of {"url": ..., "weight": ...} objects. Characters that keep the default
+        endpoint use the ENDPOINT hosts instead, if given.
+
+        :param default_hosts: The ENDPOINT hosts from the environment or config.yaml, comma separated,
+            each with port 8000 unless it names one.
+        :type default_hosts: str
+        :return: The URLs of the completion endpoints with their weights, as (url, weight) pairs.
+        :rtype: list
+        """
+        endpoints = self.config['model_provider']['endpoint']
+        if not isinstance(endpoints, list):
+            endpoints = [endpoints]
+        if default_hosts and endpoints == [DEFAULT_ENDPOINT]:
+            endpoints = [f"http://{host}/completion" if ':' in host else f"http://{host}:8000/completion"
+                         for host in (i.strip() for i in default_hosts.split(',')) if host]
+        return [(i, 1) if isinstance(i, str) else (i['url'], i.get('weight', 1)) for i in endpoints]
+
+
+class TriggerMatcher:
+    """Finds the characters whose nicknames appear in a message, using one compiled pattern for all characters."""
+
+    def __init__(self, characters):
+        """Initialize a TriggerMatcher.
+
+        :param characters: The characters to match nicknames of.
+        :type characters: list
+        """
+        nicknames = {}
+        for character in characters:
+            for nickname in character.nicknames:
+                if nickname:
+                    nicknames.setdefault(nickname.lower(), []).append(character)
+        # a match also counts for every nickname contained in the matched one
+        self.characters = {
+            nickname: list({id(c): c for other in nicknames if other in nickname for c in nicknames[other]}.values())
+            for nickname in nicknames
+        }
+        # the lookahead matches at every position so overlapping nicknames are all found,
+        # longest first so a nickname is never hidden by one of its own prefixes
+        alternatives = '|'.join(re.escape(i) for i in sorted(nicknames, key=len, reverse=True))
+        self.pattern = re.compile(f'(?=({alternatives}))') if nicknames else None
+
+    def match(self, content):
+        """Find the characters whose nicknames appear in a text, ignoring case.
+
+        :param content: The text to search.
+        :type content: str
+        :return: The matched characters, in order of their first nickname in the text.
+        :rtype: list
+        """
+        if self.pattern is None:
+            return []
+        matched = {}
+        for match in self.pattern.finditer(content.lower()):
+            for character in self.characters[match.group(1)]:
+                matched.setdefault(character.key, character)
+        return list(matched.values())
@@ -0,0 +1,190 @@
+"""Runs the bot's shards in several worker processes.
+
+The coordinator splits the shards between workers, starts them and restarts
+the ones that exit. It also proxies the completion requests of all workers,
+so they share one scheduler with its global limit and fair queueing, and one
+set of backend pools with their health checks and load balancing, instead of
+each worker sending requests on its own. The queue, shedding and backend error
+metrics are therefore served by the coordinator, on the metrics port, and the
+workers serve theirs on the following ports.
+"""
+import asyncio
+import logging
+import os
+import signal
+import sys
+
+import aiohttp
+from aiohttp import web
+
+from backend import pool_for
+from character import character_names, load_character
+from metrics import REGISTRY
+from scheduler import Scheduler, Overloaded, PRIORITY_DIRECT
+
+# seconds between the identifies of shards, Discord allows one at a time by default
+IDENTIFY_INTERVAL = 5
+RESTART_DELAY = 5
+
+
+def shard_plan(count, processes):
+    """Split shards between worker processes.
+
+    :param count: The total number of shards.
+    :type count: int
+    :param processes: The number of worker processes.
+    :type processes: int
+    :return: The shard IDs of each process, empty processes left out.
+    :rtype: list
+    """
+    return [i for i in (list(range(start, count, processes)) for start in range(processes)) if i]
+
+
+async def recommended_shards(token):
+    """Ask Discord how many shards the bot should run.
+
+    :param token: The bot token.
+    :type token: str
+    :return: The recommended number of shards.
+    :rtype: int
+    """
+    async with aiohttp.ClientSession() as session:
+        async with session.get('https://discord.com/api/v10/gateway/bot', headers={'Authorization': f'Bot {token}'}) as resp:
+            resp.raise_for_status()
+            return (await resp.json())['shards']
+
+
+class Coordinator:
+    def __init__(self, config, token, processes, count=None, proxy_port=8790):
+        """Initialize a Coordinator.
+
+        :param config: The parsed config.yaml.
+        :type config: dict
+        :param token: The bot token.
+        :type token: str
+        :param processes: The number of worker processes.
+        :type processes: int
+        :param count: The total number of shards, Discord's recommendation if not given.
+        :type count: int, optional
+        :param proxy_port: The port of the completion proxy on localhost, defaults to 8790.
+        :type proxy_port: int, optional
+        """
+        self.config = config
+        self.token = token
+        self.processes = processes
+        self.count = count
+        self.proxy_port = proxy_port
+        self.clients = {}
+        self.pools = {}
+        self.characters = {}
+        for key in character_names(config):
+            character = load_character(key)
+            self.characters[key] = pool_for(character.get_endpoints(os.getenv('ENDPOINT', config['endpoint'])),
+                                            self.clients, self.pools, config)
+        self.scheduler = Scheduler(**config['scheduler'])
+        self.metrics_port = os.getenv('METRICS_PORT') or config['metrics_port']
+        self.workers = []
+        self.stopped = asyncio.Event()
+
+    async def completion(self, request):
+        pool = self.characters.get(request.match_info['character'])
+        if pool is None:
+            return web.json_response({'error': 'unknown character'}, status=404)
+        payload = await request.json()
+        # where the request comes from, so the requests of all workers are queued fairly
+        scheduling = payload.pop('scheduling', {})
+        try:
+            async with self.scheduler.slot(scheduling.get('guild'), scheduling.get('channel'),
+                                           scheduling.get('priority', PRIORITY_DIRECT)):
+                async with pool.request(payload) as resp:
+                    proxied = web.StreamResponse(status=resp.status, headers={
+                        'Content-Type': resp.headers.get('Content-Type', 'application/json')})
+                    await proxied.prepare(request)
+                    try:
+                        async for chunk in resp.content.iter_any():
+                            await proxied.write(chunk)
+                        await proxied.write_eof()
+                    except ConnectionResetError:
+                        # the worker stops reading streams once the character's turn is over
+                        pass
+                    return proxied
+        except Overloaded as e:
+            return web.json_response({'error': str(e)}, status=429)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            return web.json_response({'error': f'no completion endpoint answered ({e!r})'}, status=502)
+
+    async def health(self, request):
+        return web.json_response({'workers': sum(1 for i in self.workers if i is not None and i.returncode is None),
+                                  'active': self.scheduler.active, 'concurrency': self.scheduler.concurrency,
+                                  'waiting': self.scheduler.waiting})
+
+    async def serve_metrics(self, request):
+        return web.Response(text=REGISTRY.render(), content_type='text/plain')
+
+    async def run_worker(self, index, shard_ids, count):
+        env = dict(os.environ, SHARD_PROCESSES='1', SHARD_COUNT=str(count),
+                   SHARD_IDS=','.join(map(str, shard_ids)), BACKEND_PROXY=f'http://127.0.0.1:{self.proxy_port}')
+        if self.metrics_port:
+            env['METRICS_PORT'] = str(int(self.metrics_port) + 1 + index)
+        # workers start one after another so their shards do not identify at once
+        await self.pause(index * len(shard_ids) * IDENTIFY_INTERVAL)
+        while not self.stopped.is_set():
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.dirname(os.path.abspath(__file__))+"/main.py", env=env)
+            self.workers[index] = process
+            logging.info(f'Started worker {index} with shards {shard_ids}.')
+            code = await process.wait()
+            if self.stopped.is_set():
+                break
+            logging.warning(f'Worker {index} exited with {code}, restarting in {RESTART_DELAY}s.')
+            await self.pause(RESTART_DELAY)
+
+    async def pause(self, seconds):
+        try:
+            await asyncio.wait_for(self.stopped.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def stop(self):
+        self.stopped.set()
+        for process in self.workers:
+            if process is not None and process.returncode is None:
+                process.terminate()
+
+    async def run(self):
+        count = self.count or await recommended_shards(self.token)
+        plan = shard_plan(count, self.processes)
+        logging.info(f'Running {count} shards in {len(plan)} workers.')
+
+        app = web.Application()
+        app.router.add_post('/completion/{character}', self.completion)
+        app.router.add_get('/health', self.health)
+        # a worker that gives up on a request, e.g. for a newer trigger, frees its place in the queue
+        runner = web.AppRunner(app, handler_cancellation=True)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', self.proxy_port).start()
+        metrics_runner = None
+        if self.metrics_port:
+            metrics_app = web.Application()
+            metrics_app.router.add_get('/metrics', self.serve_metrics)
+            metrics_runner = web.AppRunner(metrics_app)
+            await metrics_runner.setup()
+            await web.TCPSite(metrics_runner, '0.0.0.0', int(self.metrics_port)).start()
+        for pool in self.pools.values():
+            await pool.start()
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        self.workers = [None] * len(plan)
+        try:
+            await asyncio.gather(*(self.run_worker(index, shard_ids, count) for index, shard_ids in enumerate(plan)))
+        finally:
+            self.stop()
+            for pool in self.pools.values():
+                await pool.close()
+            for client in self.clients.values():
+                await client.close()
+            await runner.cleanup()
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
@@ -0,0 +1,109 @@
+"""Synthetic stand-ins for the discord.py objects the bot uses, for benchmarks and load tests."""
+import itertools
+import time
+
+# increasing like snowflakes, so buffers keep them in order
+_ids = itertools.count(1 << 40)
+
+
+def next_id():
+    return next(_ids)
+
+
+class FakeUser:
+    def __init__(self, name, id=None):
+        self.id = id or next_id()
+        self.name = name
+        self.display_name = name
+
+    @property
+    def mention(self):
+        return f'<@{self.id}>'
+
+    def mentioned_in(self, message):
+        return self.mention in message.content
+
+
+class FakeGuild:
+    def __init__(self, id=None):
+        self.id = id or next_id()
+
+
+class FakeMessage:
+    def __init__(self, content, author, channel, id=None):
+        self.id = id or next_id()
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.embeds = []
+        self.created = time.monotonic()
+
+    async def edit(self, content):
+        self.content = content
+        self.channel.edits.append((time.monotonic(), self))
+        return self
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeChannel:
+    """A guild text channel that keeps what is posted in it and what the bot sends."""
+
+    def __init__(self, client, guild=None, id=None):
+        """Initialize a FakeChannel.
+
+        :param client: The client whose user sends the bot's messages.
+        :type client: FakeClient
+        :param guild: The guild of the channel, a new one if not given.
+        :type guild: FakeGuild, optional
+        """
+        self.id = id or next_id()
+        self.client = client
+        self.guild = guild or FakeGuild()
+        self.messages = []
+        self.sent = []
+        self.edits = []
+
+    @property
+    def last_message_id(self):
+        return self.messages[-1].id if self.messages else None
+
+    def post(self, content, author):
+        """Add a message from a user to the channel, without dispatching it.
+
+        :param content: The message content.
+        :type content: str
+        :param author: The author of the message.
+        :type author: FakeUser
+        :return: The posted message.
+        :rtype: FakeMessage
+        """
+        message = FakeMessage(content, author, self)
+        self.messages.append(message)
+        return message
+
+    def typing(self):
+        return FakeTyping()
+
+    async def send(self, content):
+        message = self.post(content, self.client.user)
+        self.sent.append((time.monotonic(), message))
+        return message
+
+    async def history(self, limit=100):
+        for message in reversed(self.messages[-limit:]):
+            yield message
+
+
+class FakeClient:
+    def __init__(self, name='eliz'):
+        self.user = FakeUser(name)
+        self.guilds = []
+        self.users = []
+        self.cached_messages = []
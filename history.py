@@ -0,0 +1,245 @@
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+
+import utils
+
+
+class BufferedMessage:
+    """A message as it is kept in a MessageBuffer."""
+
+    def __init__(self, id, author, content, line):
+        """Initialize a BufferedMessage.
+
+        :param id: The Discord message ID.
+        :type id: int
+        :param author: The name of the message author.
+        :type author: str
+        :param content: The raw message content, used for spam detection.
+        :type content: str
+        :param line: The cleaned conversation line, or None if the message is not part of the context.
+        :type line: str
+        """
+        self.id = id
+        self.author = author
+        self.content = content
+        self.line = line
+
+
+class MessageBuffer:
+    """A ring buffer holding the most recent messages of a channel, ordered by message ID.
+
+    Messages that are near-duplicates of a newer one are marked as spam as they come and go.
+    """
+
+    def __init__(self, maxlen=40, spam_threshold=0.8):
+        """Initialize a MessageBuffer.
+
+        :param maxlen: The maximum number of messages kept, defaults to 40.
+        :type maxlen: int, optional
+        :param spam_threshold: The similarity above which a message counts as a duplicate, defaults to 0.8.
+        :type spam_threshold: float, optional
+        """
+        self.maxlen = maxlen
+        self.messages = OrderedDict()
+        self.spam = utils.SpamFilter(spam_threshold)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages.values())
+
+    def __reversed__(self):
+        return reversed(self.messages.values())
+
+    def __contains__(self, message_id):
+        return message_id in self.messages
+
+    def without_spam(self):
+        """Get the messages that are not near-duplicates of a newer one.
+
+        :return: The messages, oldest first.
+        :rtype: list
+        """
+        return [message for message in self.messages.values() if message.id not in self.spam.duplicates]
+
+    def append(self, message):
+        """Add a message, evicting the oldest one if the buffer is full.
+
+        :param message: The message to add.
+        :type message: BufferedMessage
+        """
+        if self.messages and message.id <= next(reversed(self.messages)):
+            self.extend([message])
+            return
+        self.messages[message.id] = message
+        self.spam.add(message.id, message.content)
+        while len(self.messages) > self.maxlen:
+            self.spam.remove(self.messages.popitem(last=False)[0])
+
+    def extend(self, messages):
+        """Merge messages into the buffer, keeping it ordered by message ID.
+
+        :param messages: The messages to merge.
+        :type messages: list
+        """
+        merged = dict(self.messages)
+        for message in messages:
+            merged.setdefault(message.id, message)
+        kept = OrderedDict((i, merged[i]) for i in sorted(merged)[-self.maxlen:])
+        for i in self.messages.keys() - kept.keys():
+            self.spam.remove(i)
+        for i in kept.keys() - self.messages.keys():
+            self.spam.add(i, kept[i].content)
+        self.messages = kept
+
+    def update(self, message):
+        """Replace a buffered message, e.g. after it was edited.
+
+        :param message: The new version of the message.
+        :type message: BufferedMessage
+        """
+        old = self.messages.get(message.id)
+        if old is not None:
+            self.messages[message.id] = message
+            if old.content != message.content:
+                self.spam.remove(message.id)
+                self.spam.add(message.id, message.content)
+
+    def remove(self, message_id):
+        """Remove a message from the buffer if it is present.
+
+        :param message_id: The ID of the message to remove.
+        :type message_id: int
+        """
+        if self.messages.pop(message_id, None) is not None:
+            self.spam.remove(message_id)
+
+
+class TranscriptStore:
+    """Keeps the recent messages of every buffered channel in SQLite, so buffers survive a restart.
+
+    Lines can be stored with their token IDs, so a StableContext needs no tokenizing after a restart either.
+    Changes are collected in memory and written by flush, which can run on a thread.
+    """
+
+    def __init__(self, path, limit=40, tokens=False):
+        """Initialize a TranscriptStore.
+
+        :param path: The path of the SQLite database, created if missing.
+        :type path: str
+        :param limit: The number of messages kept per channel, defaults to 40.
+        :type limit: int, optional
+        :param tokens: Whether to store the token IDs of lines and make them known to encode when loading,
+            only StableContext encodes lines one by one, defaults to False.
+        :type tokens: bool, optional
+        """
+        self.limit = limit
+        self.tokens = tokens
+        # add, update and remove run on the event loop, so they never wait for the database
+        self.pending_lock = threading.Lock()
+        self.connection_lock = threading.Lock()
+        # (channel ID, message ID) -> BufferedMessage to insert, or (BufferedMessage,) to update, or None to delete
+        self.pending = {}
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS messages (channel INTEGER, id INTEGER, author TEXT, content TEXT, '
+                                    'line TEXT, tokens BLOB, PRIMARY KEY (channel, id)) WITHOUT ROWID')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'tokenizer'").fetchone()
+            if row is None or row[0] != utils.tokenizer_name:
+                # token IDs of another tokenizer are of no use
+                self.connection.execute('UPDATE messages SET tokens = NULL')
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('tokenizer', ?)", (utils.tokenizer_name,))
+
+    def load(self, channel_id):
+        """Load the stored messages of a channel and make their token IDs known to encode if they are kept.
+
+        :param channel_id: The channel ID.
+        :type channel_id: int
+        :return: The stored messages, oldest first.
+        :rtype: list
+        """
+        with self.connection_lock:
+            rows = self.connection.execute('SELECT id, author, content, line, tokens FROM messages WHERE channel = ? '
+                                           'ORDER BY id DESC LIMIT ?', (channel_id, self.limit)).fetchall()
+        messages = []
+        for id, author, content, line, tokens in reversed(rows):
+            if self.tokens and line is not None and tokens is not None:
+                utils.remember_tokens('\n' + line, array('I', tokens))
+            messages.append(BufferedMessage(id, author, content, line))
+        return messages
+
+    def add(self, channel_id, message):
+        """Store a message at the next flush.
+
+        :param channel_id: The channel ID.
+        :type channel_id: int
+        :param message: The message.
+        :type message: BufferedMessage
+        """
+        with self.pending_lock:
+            self.pending[channel_id, message.id] = message
+
+    def update(self, channel_id, message):
+        """Replace a stored message at the next flush, e.g. after it was edited, if it is stored.
+
+        :param channel_id: The channel ID.
+        :type channel_id: int
+        :param message: The new version of the message.
+        :type message: BufferedMessage
+        """
+        with self.pending_lock:
+            if isinstance(self.pending.get((channel_id, message.id)), BufferedMessage):
+                self.pending[channel_id, message.id] = message
+            else:
+                self.pending[channel_id, message.id] = (message,)
+
+    def remove(self, channel_id, message_id):
+        """Delete a message at the next flush.
+
+        :param channel_id: The channel ID.
+        :type channel_id: int
+        :param message_id: The message ID.
+        :type message_id: int
+        """
+        with self.pending_lock:
+            self.pending[channel_id, message_id] = None
+
+    def flush(self):
+        """Write the collected changes and drop the messages beyond the limit of each changed channel."""
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        # tokenized outside the lock, lines of the same text are cached by encode
+        def row(channel_id, message):
+            return (channel_id, message.id, message.author, message.content, message.line,
+                    array('I', utils.encode('\n' + message.line)).tobytes() if self.tokens and message.line is not None else None)
+        inserted = [row(channel_id, message) for (channel_id, _), message in pending.items()
+                    if isinstance(message, BufferedMessage)]
+        updated = [row(channel_id, message[0])[2:] + (channel_id, message[0].id)
+                   for (channel_id, _), message in pending.items() if isinstance(message, tuple)]
+        deleted = [key for key, message in pending.items() if message is None]
+        with self.connection_lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)', inserted)
+            self.connection.executemany(
+                'UPDATE messages SET author = ?, content = ?, line = ?, tokens = ? WHERE channel = ? AND id = ?', updated)
+            self.connection.executemany(
+                'DELETE FROM messages WHERE channel = ? AND id = ?', deleted)
+            self.connection.executemany('DELETE FROM messages WHERE channel = ? AND id < '
+                                        '(SELECT id FROM messages WHERE channel = ? ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                                        [(channel_id, channel_id, self.limit - 1) for channel_id in {i[0] for i in pending}])
+
+    def close(self):
+        """Write the collected changes and close the database."""
+        self.flush()
+        with self.connection_lock:
+            self.connection.close()
@@ -0,0 +1,179 @@
+"""Load test of the bot against the local completion stand-in, without a gateway connection.
+
+Every simulated channel mentions the character, waits for the reply and mentions
+it again, for increasing numbers of channels at once. Messages go through the
+real on_message -> respond path. Reports end-to-end latency percentiles,
+throughput and event loop lag per concurrency level.
+
+    python loadtest.py --concurrency 1 4 16 64 --latency 0.5 --slots 8
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+
+from aiohttp import web
+
+from bot import DiscordBot
+from fakediscord import FakeChannel, FakeClient, FakeUser
+from standin import SHAPES, StandinServer
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class LoadChannel(FakeChannel):
+    """A FakeChannel that hands the bot's replies back to it like the gateway would and signals them."""
+
+    def __init__(self, client, bot):
+        super().__init__(client)
+        self.bot = bot
+        self.replied = asyncio.Event()
+
+    async def send(self, content):
+        message = await super().send(content)
+        self.replied.set()
+        await self.bot.on_message(message)
+        return message
+
+
+class LagMonitor:
+    """Measures how late the event loop wakes up a task that sleeps for a fixed interval."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+
+    async def run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lags.append(time.monotonic() - started - self.interval)
+
+
+async def simulate_channel(bot, channel, user, words, duration, timeout, latencies, failures):
+    deadline = time.monotonic() + duration
+    rng = random.Random(channel.id)
+    while time.monotonic() < deadline:
+        channel.replied.clear()
+        message = channel.post(
+            f'{bot.client.user.mention} ' + ' '.join(rng.choice(words) for _ in range(12)), user)
+        started = time.monotonic()
+        await bot.on_message(message)
+        try:
+            await asyncio.wait_for(channel.replied.wait(), timeout)
+        except asyncio.TimeoutError:
+            failures['timeout'] += 1
+            continue
+        if channel.sent[-1][1].content.startswith('error'):
+            failures['error'] += 1
+        latencies.append(time.monotonic() - started)
+
+
+async def run_level(bot, client, concurrency, args):
+    words = next(iter(bot.characters.values())).config['prompt'].split()
+    channels = [LoadChannel(client, bot) for _ in range(concurrency)]
+    latencies = []
+    failures = {'timeout': 0, 'error': 0}
+    monitor = LagMonitor()
+    lag_task = asyncio.create_task(monitor.run())
+    started = time.monotonic()
+    await asyncio.gather(*(simulate_channel(bot, channel, FakeUser(f'user{i}'), words, args.duration, args.timeout, latencies, failures)
+                           for i, channel in enumerate(channels)))
+    elapsed = time.monotonic() - started
+    lag_task.cancel()
+    return {
+        'concurrency': concurrency,
+        'replies': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'mean': statistics.mean(latencies) if latencies else None,
+        'timeouts': failures['timeout'],
+        'errors': failures['error'],
+        'loop_lag_p50': percentile(monitor.lags, 50),
+        'loop_lag_p99': percentile(monitor.lags, 99),
+        'loop_lag_max': max(monitor.lags) if monitor.lags else None,
+    }
+
+
+def ms(value):
+    return f'{value * 1000:8.1f}' if value is not None else '       -'
+
+
+async def main(args):
+    runners = []
+    urls = []
+    for i in range(args.backends):
+        server = StandinServer(token_delay=args.token_delay, latency=args.latency, jitter=args.jitter,
+                               error_rate=args.error_rate, shape=args.shape, slots=args.slots, seed=i)
+        runner = web.AppRunner(server.app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', args.port + i)
+        await site.start()
+        runners.append(runner)
+        urls.append(f'http://127.0.0.1:{args.port + i}/completion')
+
+    client = FakeClient()
+    bot = DiscordBot(client)
+    bot.debounce = args.debounce
+    if args.generating:
+        bot.scheduler.limit = args.generating
+    bot.backends.clear()
+    bot.pools.clear()
+    for character in bot.characters.values():
+        bot.connect(character, [(url, 1) for url in urls])
+    await bot.cog_load()
+
+    results = []
+    print(f"{'channels':>8} {'replies':>8} {'reply/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'lag p99':>8} {'lag max':>8} {'timeout':>8} {'error':>8}")
+    try:
+        for concurrency in args.concurrency:
+            result = await run_level(bot, client, concurrency, args)
+            results.append(result)
+            print(f"{concurrency:>8} {result['replies']:>8} {result['throughput']:8.1f} {ms(result['p50'])} {ms(result['p95'])} "
+                  f"{ms(result['p99'])} {ms(result['loop_lag_p99'])} {ms(result['loop_lag_max'])} "
+                  f"{result['timeouts']:>8} {result['errors']:>8}")
+    finally:
+        await bot.cog_unload()
+        for runner in runners:
+            await runner.cleanup()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int,
+                        nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds per concurrency level')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds to wait for a reply')
+    parser.add_argument('--debounce', type=float, default=0,
+                        help='reply debounce of the bot')
+    parser.add_argument('--generating', type=int, default=None,
+                        help='generation requests of the bot at once, from config.yaml if not given')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='port of the first stand-in, the others use the following ones')
+    parser.add_argument('--backends', type=int, default=1,
+                        help='stand-in servers the requests are balanced over')
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--shape', choices=SHAPES, default='turns')
+    parser.add_argument('--slots', type=int, default=0)
+    parser.add_argument('--token-delay', type=float, default=0.02)
+    parser.add_argument('--output', default=None)
+    asyncio.run(main(parser.parse_args()))
@@ -1,33 +1,71 @@
+import asyncio
 import os
+import time
 from dotenv import load_dotenv
 import logging
-import json
 import yaml
 
 import discord
 from discord.ext import commands
 
+from character import character_names, load_character
+
+started = time.monotonic()
 load_dotenv()
+
+with open(os.path.dirname(os.path.abspath(__file__))+"/config.yaml", "r") as f:
+    config = yaml.safe_load(f)
+
+# shards of this process, all of them if not set, empty variables count as unset as docker-compose passes them
+shard_count = os.getenv('SHARD_COUNT') or config['shards']['count']
+shard_count = int(shard_count) if shard_count else None
+shard_ids = os.getenv('SHARD_IDS') or config['shards']['ids']
+if isinstance(shard_ids, str):
+    shard_ids = [int(i) for i in shard_ids.split(',') if i.strip()]
+shard_ids = shard_ids or None
+processes = int(os.getenv('SHARD_PROCESSES') or config['shards']['processes'] or 1)
+
 logging.basicConfig(
     handlers=[logging.FileHandler(
         os.path.dirname(os.path.abspath(__file__))+"/log", "a", "utf-8")],
     level=logging.INFO,
-    format="%(asctime)s %(message)s",
+    format=f"%(asctime)s [shards {','.join(map(str, shard_ids))}] %(message)s" if shard_ids else "%(asctime)s %(message)s",
     datefmt="%m/%d/%Y %I:%M:%S %p",
 )
 
-with open(os.path.dirname(os.path.abspath(__file__))+"/config.yaml", "r") as f:
-    config = yaml.safe_load(f)
+if processes > 1:
+    # this process only coordinates, the shards run in worker processes started by it
+    from coordinator import Coordinator
+    asyncio.run(Coordinator(config, os.getenv("DISCORD_TOKEN", config["discord_token"]), processes, shard_count,
+                            int(os.getenv('PROXY_PORT') or config['shards']['proxy_port'])).run())
+    raise SystemExit
+if shard_ids and not shard_count:
+    raise SystemExit('shards.ids needs shards.count, the total number of shards.')
 
 
-class Client(commands.Bot):
+class Client(commands.AutoShardedBot):
     def __init__(self):
-        intents = discord.Intents.all()
+        options = {}
+        if os.getenv('GATEWAY_MODE', config['gateway_mode']).lower() == 'lean':
+            # only what on_message needs: guild channels, messages with their content, edits and deletes
+            intents = discord.Intents.none()
+            intents.guilds = True
+            intents.messages = True
+            intents.message_content = True
+            # the bot keeps its own buffers, so discord.py needs no members and few messages
+            options = dict(member_cache_flags=discord.MemberCacheFlags.none(), chunk_guilds_at_startup=False,
+                           max_messages=int(config['message_cache']) or None)
+        else:
+            intents = discord.Intents.all()
         super().__init__(command_prefix=os.getenv(
-            "DISCORD_PREFIX", config['discord_prefix']), intents=intents)
+            "DISCORD_PREFIX", config['discord_prefix']), intents=intents,
+            shard_count=shard_count, shard_ids=shard_ids, **options)
 
     async def setup_hook(self):
+        extension_started = time.monotonic()
         await client.load_extension("bot")
+        logging.info(
+            f'Loaded extension in {time.monotonic() - extension_started:.2f}s.')
 
     async def on_command_error(self, ctx, error):
         if isinstance(error, commands.CommandNotFound):
@@ -38,15 +76,16 @@ class Client(commands.Bot):
 client = Client()
 client.remove_command("help")
 
-activity = None
-with open(os.path.dirname(os.path.abspath(__file__))+f"/config/{os.getenv('CONFIG', config['config'])}.json", encoding="utf-8") as f:
-    activity = json.load(f)["client_args"]["status"]
+# with several characters the account shows the status of the first one
+activity = load_character(character_names(config)[0]).config["client_args"]["status"]
 
 
 @client.event
 async def on_ready():
     if activity and os.getenv("DISCORD_STATUS", config["discord_status"]).lower() == "on":
         await client.change_presence(activity=discord.CustomActivity(activity))
-    print("Logged in as {0} ({0.id})".format(client.user))
+    print("Logged in as {0} ({0.id}), shards {1} of {2}".format(
+        client.user, client.shard_ids or 'all', client.shard_count))
+    logging.info(f'Ready {time.monotonic() - started:.2f}s after start.')
 
 client.run(os.getenv("DISCORD_TOKEN", config["discord_token"]), reconnect=True)
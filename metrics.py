@@ -0,0 +1,158 @@
+"""Counters and histograms for the reply pipeline, rendered in the Prometheus text format."""
+import os
+import resource
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    """A monotonically increasing count, one per combination of labels."""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(i, '') for i in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} counter']
+        for key, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{_labels(self.labels, key)} {value}')
+        return lines
+
+
+class Histogram:
+    """Observed values sorted into cumulative buckets, one set per combination of labels."""
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self.labels = tuple(labels)
+        # labels -> [bucket counts..., +Inf count], sum
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(i, '') for i in self.labels)
+        if key not in self.values:
+            self.values[key] = [[0] * (len(self.buckets) + 1), 0]
+        counts = self.values[key]
+        counts[0][bisect_left(self.buckets, value)] += 1
+        counts[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in a with block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def quantile(self, q, **labels):
+        """Estimate a quantile as the upper bound of the bucket it falls into.
+
+        :param q: The quantile, between 0 and 1.
+        :type q: float
+        :return: The estimate, infinite if it is above the largest bucket, or None without observations.
+        :rtype: float
+        """
+        key = tuple(labels.get(i, '') for i in self.labels)
+        if key not in self.values:
+            return None
+        counts = self.values[key][0]
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + [float('inf')], counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def count(self, **labels):
+        key = tuple(labels.get(i, '') for i in self.labels)
+        return sum(self.values[key][0]) if key in self.values else 0
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} histogram']
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ['+Inf'], counts):
+                cumulative += count
+                lines.append(
+                    f'{self.name}_bucket{_labels(self.labels + ("le",), key + (bound,))} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, key)} {total}')
+            lines.append(
+                f'{self.name}_count{_labels(self.labels, key)} {cumulative}')
+        return lines
+
+
+def resident_memory():
+    """Get the memory the process uses now and at most so far.
+
+    :return: The resident and peak resident set size in bytes, the resident size is None where /proc is missing.
+    :rtype: tuple
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    try:
+        with open('/proc/self/statm') as f:
+            resident = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        resident = None
+    return resident, peak
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        self.metrics.append(Counter(name, help, labels))
+        return self.metrics[-1]
+
+    def histogram(self, name, help, buckets, labels=()):
+        self.metrics.append(Histogram(name, help, buckets, labels))
+        return self.metrics[-1]
+
+    def render(self):
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+
+REGISTRY = Registry()
+
+SECONDS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+STAGES = ['history', 'build_ctx', 'queue',
+          'generate', 'first_text', 'send', 'reply']
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'eliz_stage_seconds', 'Seconds spent in each stage of a reply.', SECONDS_BUCKETS, ['stage'])
+CONTEXT_TOKENS = REGISTRY.histogram(
+    'eliz_context_tokens', 'Tokens in the contexts sent to the backend.', [128, 256, 512, 768, 1024, 2048, 4096, 8192, 16384, 32768])
+TRIGGERS = REGISTRY.counter(
+    'eliz_triggers_total', 'Messages that triggered a reply.', ['character'])
+COALESCED = REGISTRY.counter(
+    'eliz_coalesced_total', 'Pending replies replaced by a newer trigger in the same channel.')
+REPLIES = REGISTRY.counter(
+    'eliz_replies_total', 'Replies sent.', ['character'])
+REPLY_TOKENS = REGISTRY.histogram(
+    'eliz_reply_tokens', 'Tokens in the replies sent.', [8, 16, 32, 64, 128, 256, 512])
+DISCARDED_TOKENS = REGISTRY.counter(
+    'eliz_discarded_tokens_total', 'Generated tokens after the end of the character\'s turn, of responses that were not streamed.')
+SHED = REGISTRY.counter(
+    'eliz_shed_total', 'Replies dropped because too many generation requests were waiting.', ['priority'])
+BACKEND_ERRORS = REGISTRY.counter(
+    'eliz_backend_errors_total', 'Failed completion requests, including retried ones.', ['kind'])
@@ -0,0 +1,169 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from metrics import STAGE_SECONDS, SHED
+
+# requests are served by priority first, DMs and mentions before nickname matches
+PRIORITY_DIRECT = 0
+PRIORITY_NICKNAME = 1
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed because too many are waiting."""
+
+
+class Scheduler:
+    """Limits how many generation requests run at once and queues the rest fairly.
+
+    Waiting requests are served by priority, then round robin over guilds and
+    over the channels of each guild, so one busy server cannot starve the others.
+    """
+
+    def __init__(self, concurrency=8, max_queue=64, latency_target=0, max_concurrency=32):
+        """Initialize a Scheduler.
+
+        :param concurrency: How many requests run at once, defaults to 8.
+        :type concurrency: int, optional
+        :param max_queue: How many requests may wait before new ones are shed, defaults to 64.
+        :type max_queue: int, optional
+        :param latency_target: Seconds a request should take at most. If set, the concurrency is lowered
+            when requests take longer and raised again while they are faster and requests are waiting,
+            defaults to 0, which keeps the concurrency fixed.
+        :type latency_target: float, optional
+        :param max_concurrency: The highest the concurrency is raised to, defaults to 32.
+        :type max_concurrency: int, optional
+        """
+        self.limit = float(concurrency)
+        self.max_queue = max_queue
+        self.latency_target = latency_target
+        self.max_concurrency = max(max_concurrency, concurrency)
+        self.active = 0
+        self.waiting = 0
+        # priority -> guild -> channel -> waiting futures, each level in round robin order
+        self.queues = {PRIORITY_DIRECT: OrderedDict(),
+                       PRIORITY_NICKNAME: OrderedDict()}
+        self.last_decrease = 0
+
+    @property
+    def concurrency(self):
+        return max(1, int(self.limit))
+
+    @asynccontextmanager
+    async def slot(self, guild, channel, priority=PRIORITY_DIRECT):
+        """Wait for a free slot and hold it for the duration of a with block.
+
+        :param guild: The guild ID, or None for DMs.
+        :type guild: int
+        :param channel: The channel ID.
+        :type channel: int
+        :param priority: PRIORITY_DIRECT or PRIORITY_NICKNAME, defaults to PRIORITY_DIRECT.
+        :type priority: int, optional
+        :raises Overloaded: If too many requests are waiting already.
+        """
+        with STAGE_SECONDS.time(stage='queue'):
+            await self.acquire(guild, channel, priority)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    async def acquire(self, guild, channel, priority=PRIORITY_DIRECT):
+        if self.active < self.concurrency and not self.waiting:
+            self.active += 1
+            return
+        if self.waiting >= self.max_queue and not self.shed(priority):
+            SHED.inc(priority=priority)
+            raise Overloaded(f'{self.waiting} requests are waiting already.')
+        future = asyncio.get_running_loop().create_future()
+        channels = self.queues[priority].setdefault(guild, OrderedDict())
+        channels.setdefault(channel, deque()).append(future)
+        self.waiting += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # the slot was handed over just before the cancellation, not shed
+                self.release()
+            else:
+                self.discard(priority, guild, channel, future)
+            raise
+
+    def release(self, latency=None):
+        self.active -= 1
+        if latency is not None and self.latency_target:
+            self.adapt(latency)
+        self.dispatch()
+
+    def adapt(self, latency):
+        now = time.monotonic()
+        if latency > self.latency_target:
+            # back off at most once per target interval, the requests running now started under the old limit
+            if now - self.last_decrease > self.latency_target:
+                self.limit = max(1.0, self.limit * 0.75)
+                self.last_decrease = now
+        elif self.waiting:
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def dispatch(self):
+        while self.active < self.concurrency and self.waiting:
+            future = self.pop()
+            if not future.cancelled():
+                self.active += 1
+                future.set_result(None)
+
+    def pop(self):
+        for guilds in self.queues.values():
+            if not guilds:
+                continue
+            guild, channels = next(iter(guilds.items()))
+            channel, futures = next(iter(channels.items()))
+            future = futures.popleft()
+            self.waiting -= 1
+            # move both on to the end so the next request comes from another channel and guild
+            channels.move_to_end(channel)
+            if not futures:
+                del channels[channel]
+            guilds.move_to_end(guild)
+            if not channels:
+                del guilds[guild]
+            return future
+
+    def discard(self, priority, guild, channel, future):
+        channels = self.queues[priority].get(guild)
+        if channels is None or channel not in channels or future not in channels[channel]:
+            return
+        channels[channel].remove(future)
+        self.waiting -= 1
+        if not channels[channel]:
+            del channels[channel]
+            if not channels:
+                del self.queues[priority][guild]
+
+    def shed(self, priority):
+        """Make room for a request by dropping a waiting one of lower priority.
+
+        The newest request of the guild with the most waiting ones is dropped.
+
+        :param priority: The priority of the new request.
+        :type priority: int
+        :return: Whether a request was dropped.
+        :rtype: bool
+        """
+        for lower in sorted(self.queues, reverse=True):
+            if lower <= priority:
+                break
+            guilds = self.queues[lower]
+            if not guilds:
+                continue
+            guild = max(guilds, key=lambda g: sum(len(i) for i in guilds[g].values()))
+            channel = max(guilds[guild], key=lambda c: len(guilds[guild][c]))
+            future = guilds[guild][channel][-1]
+            self.discard(lower, guild, channel, future)
+            SHED.inc(priority=lower)
+            if not future.done():
+                future.set_exception(Overloaded('Dropped for a request of higher priority.'))
+            return True
+        return False
@@ -0,0 +1,160 @@
+"""A local stand-in for the completion endpoint, for trying the bot without a GPU server.
+
+Run with ``python standin.py --port 8000`` and point ``endpoint`` in config.yaml at it.
+Latency, errors and the shape of the answers can be configured to see how the bot copes.
+"""
+import argparse
+import asyncio
+import json
+import random
+
+from aiohttp import web
+
+REPLY = 'I am only a stand-in, but I am listening.'
+
+# how the generated text is shaped
+SHAPES = [
+    'turns',    # the character's line followed by a line for another speaker, like a real model
+    'single',   # only the character's line
+    'no-turn',  # text that never contains the character's line
+    'error',    # an {"error": ...} body instead of generated text
+]
+
+
+def apply_limits(text, stop=(), max_new_tokens=None):
+    """Cut generated text at the first stop sequence and at the token limit, counting words as tokens.
+
+    :param text: The generated text.
+    :type text: str
+    :param stop: The stop sequences, defaults to none.
+    :type stop: list, optional
+    :param max_new_tokens: The most words to generate, unlimited if not given.
+    :type max_new_tokens: int, optional
+    :return: The text that would have been generated.
+    :rtype: str
+    """
+    for sequence in stop:
+        if sequence in text:
+            text = text[:text.index(sequence)]
+    if max_new_tokens is not None:
+        # the text starts with a space, so the first piece is empty
+        text = ' '.join(text.split(' ')[:max_new_tokens + 1])
+    return text
+
+
+def continuation(prompt, shape='turns'):
+    """Make up the text the model would generate after the prompt.
+
+    :param prompt: The prompt, ending with the character's name and a colon.
+    :type prompt: str
+    :param shape: One of SHAPES, defaults to turns.
+    :type shape: str, optional
+    :return: The generated continuation.
+    :rtype: str
+    """
+    # go on with whoever spoke before the character, like a model does
+    lines = prompt.split('\n')
+    speaker = lines[-2].partition(':')[0] if len(lines) > 1 and ':' in lines[-2] else 'someone'
+    if shape == 'single':
+        return f' {REPLY}\n'
+    if shape == 'no-turn':
+        # drop the character's turn the prompt ends with
+        return f'\n{speaker}: the character never got to speak\n'
+    return f' {REPLY}\n{speaker}: and another turn nobody asked for\n'
+
+
+class StandinServer:
+    """An aiohttp application that answers like the completion endpoint."""
+
+    def __init__(self, token_delay=0.02, latency=0, jitter=0, error_rate=0, shape='turns', slots=0, seed=None):
+        """Initialize a StandinServer.
+
+        :param token_delay: Seconds between streamed words, defaults to 0.02.
+        :type token_delay: float, optional
+        :param latency: Seconds before an answer starts, defaults to 0.
+        :type latency: float, optional
+        :param jitter: Maximum random seconds added to or taken from the latency, defaults to 0.
+        :type jitter: float, optional
+        :param error_rate: Share of requests answered with a 500 error, defaults to 0.
+        :type error_rate: float, optional
+        :param shape: One of SHAPES, defaults to turns.
+        :type shape: str, optional
+        :param slots: How many requests are generated at once, like GPU batch slots, unlimited if 0, defaults to 0.
+        :type slots: int, optional
+        :param seed: Seed for latency jitter and errors, defaults to None.
+        :type seed: int, optional
+        """
+        self.token_delay = token_delay
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.shape = shape
+        self.slots = asyncio.Semaphore(slots) if slots else None
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.words = 0
+        # health checks fail while this is False, requests are still answered
+        self.healthy = True
+        self.app = web.Application()
+        self.app.router.add_post('/completion', self.completion)
+        self.app.router.add_get('/health', self.health)
+
+    async def health(self, request):
+        return web.json_response({'healthy': self.healthy}, status=200 if self.healthy else 503)
+
+    async def completion(self, request):
+        payload = await request.json()
+        self.requests += 1
+        if self.slots is None:
+            return await self.generate(request, payload)
+        async with self.slots:
+            return await self.generate(request, payload)
+
+    async def generate(self, request, payload):
+        await asyncio.sleep(max(0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({'error': 'stand-in failure'}, status=500)
+        if self.shape == 'error':
+            return web.json_response({'error': 'stand-in error'})
+
+        prompt = payload.get('prompt', '')
+        text = apply_limits(continuation(prompt, self.shape), payload.get(
+            'stop_sequences', ()), payload.get('max_new_tokens'))
+        self.words += len(text.split())
+        if not payload.get('stream'):
+            return web.json_response([{'generated_text': prompt + text}])
+
+        resp = web.StreamResponse(
+            headers={'Content-Type': 'text/event-stream'})
+        await resp.prepare(request)
+        try:
+            for word in text.split(' '):
+                await asyncio.sleep(self.token_delay)
+                await resp.write(f'data: {json.dumps({"text": word + " "})}\n\n'.encode('utf-8'))
+            await resp.write(b'data: [DONE]\n\n')
+        except ConnectionResetError:
+            # the client stops reading once the character's turn is over
+            pass
+        return resp
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--token-delay', type=float, default=0.02)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--shape', choices=SHAPES, default='turns')
+    parser.add_argument('--slots', type=int, default=0)
+    args = parser.parse_args()
+    server = StandinServer(args.token_delay, args.latency, args.jitter,
+                           args.error_rate, args.shape, args.slots)
+    web.run_app(server.app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,7 @@
 # export DISCORD_STATUS="off"
 # export CONFIG="aya"
 # export ENDPOINT="192.168.2.59"
+# export TRANSCRIPTS="transcripts.db"
 
 $(dirname "$0")/venv/bin/python $(dirname "$0")/main.py
 echo "Exited"
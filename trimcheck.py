@@ -0,0 +1,147 @@
+"""Regression check for the trimming functions in utils.
+
+Compares trim_newlines, trim_sentences and trim_tokens in both directions against
+reference implementations on random texts made from the words of the prompts in
+config/, and exits with status 1 if any output differs.
+
+The references re-encode the kept text at every step, like the trimming code did
+before it was made linear. The newline, token and TRIM_DIR_TOP sentence references
+are the old code. The old TOP code found each sentence with text.rindex, which picks
+a later occurrence when the sentence also appears inside later text. Texts where that
+happens are counted as known differences instead of failures. The old TRIM_DIR_BOTTOM
+code added an offset to text.index that drifted away from the real position of every
+sentence after the first, which was fixed on purpose. Its reference keeps whole leading
+sentences at their real positions instead.
+
+    python trimcheck.py
+    python trimcheck.py --texts 10000 --seed 1
+"""
+import argparse
+import glob
+import json
+import os
+import random
+
+import utils
+
+PUNCTUATION = ['', '', '', '.', '!', '?', ',', '?!', ' :)']
+SEPARATORS = [' ', ' ', '\n', '  ', '\n\n', '. ']
+
+
+def reference_newlines(tokens, trim_dir, limit):
+    if (trim_dir == utils.TRIM_DIR_NONE) or (len(tokens) <= limit):
+        return tokens
+    tokenizer = utils.get_tokenizer()
+    lines = tokenizer.decode(tokens).split('\n')
+    if trim_dir == utils.TRIM_DIR_TOP:
+        lines = ['\n' + line for line in reversed(lines)]
+    else:
+        lines = [line + '\n' for line in lines]
+    kept = []
+    for line in lines:
+        new_tokens = tokenizer.encode(line)
+        if len(new_tokens) + len(kept) > limit:
+            break
+        kept = new_tokens + kept if trim_dir == utils.TRIM_DIR_TOP else kept + new_tokens
+    return kept
+
+
+def reference_sentences(tokens, trim_dir, limit):
+    if (trim_dir == utils.TRIM_DIR_NONE) or (len(tokens) <= limit):
+        return tokens
+    tokenizer = utils.get_tokenizer()
+    text = tokenizer.decode(tokens)
+    sentences = utils.split_into_sentences(text)
+    if trim_dir == utils.TRIM_DIR_TOP:
+        text_end = len(text)
+        for sentence in reversed(sentences):
+            sentence_idx = text.rindex(sentence)
+            if (sentence_idx > 0) and (sentence_idx < len(text)) and (text[sentence_idx] == ' '):
+                sentence_idx -= 1
+            if len(tokenizer.encode(text[sentence_idx:])) >= limit:
+                return tokenizer.encode(text[text_end:])
+            text_end = sentence_idx - 1
+    else:
+        last_sentence_idx = 0
+        sentence_end = -1
+        for sentence in sentences:
+            # sentences are split at exactly one whitespace character
+            sentence_end += 1 + len(sentence)
+            end = sentence_end
+            if (end < len(text)) and (text[end:end+1] == '\n'):
+                end += 1
+            if len(tokenizer.encode(text[0:end])) >= limit:
+                return tokenizer.encode(text[0:last_sentence_idx])
+            last_sentence_idx = end
+    return tokens
+
+
+def rindex_misplaces(text):
+    """Check whether text.rindex finds a sentence of a text somewhere after its real position.
+
+    :param text: The text.
+    :type text: str
+    :return: Whether the old TRIM_DIR_TOP code could cut at the wrong place.
+    :rtype: bool
+    """
+    start = 0
+    for sentence in utils.split_into_sentences(text):
+        if text.rindex(sentence) != start:
+            return True
+        start += len(sentence) + 1
+    return False
+
+
+def reference_tokens(tokens, trim_dir, limit):
+    if (trim_dir == utils.TRIM_DIR_NONE) or (len(tokens) <= limit):
+        return tokens
+    if trim_dir == utils.TRIM_DIR_TOP:
+        return tokens[len(tokens)-limit:]
+    return tokens[:limit]
+
+
+CHECKS = [
+    (utils.trim_newlines, reference_newlines),
+    (utils.trim_sentences, reference_sentences),
+    (utils.trim_tokens, reference_tokens),
+]
+
+
+def random_text(rng, words):
+    pieces = []
+    for _ in range(rng.randint(1, 60)):
+        pieces.append(' '.join(rng.choice(words) for _ in range(rng.randint(1, 12))) + rng.choice(PUNCTUATION))
+    return ''.join(piece + rng.choice(SEPARATORS) for piece in pieces).rstrip(' ')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--texts', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    words = [word for path in sorted(glob.glob(os.path.dirname(os.path.abspath(__file__))+"/config/*.json"))
+             for word in json.load(open(path))['prompt'].split()]
+    rng = random.Random(args.seed)
+    failures = known = 0
+    for _ in range(args.texts):
+        tokens = utils.encode(random_text(rng, words))
+        limit = rng.randint(1, len(tokens) + 3)
+        for (fn, reference), trim_dir in ((i, d) for i in CHECKS for d in (utils.TRIM_DIR_TOP, utils.TRIM_DIR_BOTTOM)):
+            if fn(list(tokens), trim_dir, limit) == reference(list(tokens), trim_dir, limit):
+                continue
+            text = utils.get_tokenizer().decode(tokens)
+            if fn is utils.trim_sentences and trim_dir == utils.TRIM_DIR_TOP and rindex_misplaces(text):
+                known += 1
+                continue
+            failures += 1
+            if failures <= 10:
+                print(f'{fn.__name__} direction {trim_dir} limit {limit} differs for {text!r}')
+    print(f'{args.texts} texts, {args.texts * len(CHECKS) * 2} checks, {failures} differ, '
+          f'{known} known differences where text.rindex found a later sentence')
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,187 @@
-from difflib import SequenceMatcher
-from transformers import AutoTokenizer
+import asyncio
+import copy
+import os
+import re
+import threading
+from array import array
+from collections import OrderedDict, deque
+from bisect import bisect_right
+from itertools import accumulate, chain
+from zlib import crc32
+
+# tokenizers are serialized here after the first download so later starts need no network
+TOKENIZER_DIR = os.path.dirname(os.path.abspath(__file__))+"/tokenizers"
+
+# token IDs the encode cache and the remembered tokens each hold at most, kept as 4-byte integers
+ENCODE_CACHE_TOKENS = 1 << 20
+
+tokenizer_name = 'gpt2'
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+class _TokenCache:
+    """An LRU cache of token IDs by text, bounded by the total number of token IDs."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = OrderedDict()
+        self.tokens = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, text, pop=False):
+        with self.lock:
+            tokens = self.entries.pop(text, None) if pop else self.entries.get(text)
+            if tokens is not None:
+                if pop:
+                    self.tokens -= len(tokens)
+                else:
+                    self.entries.move_to_end(text)
+            return tokens
+
+    def put(self, text, tokens):
+        # texts longer than the whole cache are not kept
+        if len(tokens) > self.limit:
+            return
+        with self.lock:
+            old = self.entries.pop(text, None)
+            if old is not None:
+                self.tokens -= len(old)
+            self.entries[text] = tokens
+            self.tokens += len(tokens)
+            while self.tokens > self.limit:
+                _, old = self.entries.popitem(last=False)
+                self.tokens -= len(old)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tokens = 0
+
+
+_encoded = _TokenCache(ENCODE_CACHE_TOKENS)
+# token IDs of texts stored in a TranscriptStore, handed to the encode cache on first use
+_known_tokens = _TokenCache(ENCODE_CACHE_TOKENS)
+
+
+def set_tokenizer(name):
+    """Choose the tokenizer that is loaded on first use.
+
+    :param name: The name of a pretrained tokenizer, e.g. gpt2.
+    :type name: str
+    """
+    global tokenizer_name, _tokenizer
+    with _tokenizer_lock:
+        if name != tokenizer_name:
+            tokenizer_name = name
+            _tokenizer = None
+            clear_encode_cache()
+
+
+def load_tokenizer(name):
+    """Load a tokenizer from TOKENIZER_DIR, downloading and saving it there if it is missing.
+
+    :param name: The name of a pretrained tokenizer, e.g. gpt2.
+    :type name: str
+    :return: The loaded tokenizer.
+    :rtype: transformers.PreTrainedTokenizerFast
+    """
+    # transformers is slow to import, so it is only imported once a tokenizer is needed
+    from transformers import AutoTokenizer
+
+    path = f'{TOKENIZER_DIR}/{name}'
+    if os.path.exists(f'{path}/tokenizer.json'):
+        return AutoTokenizer.from_pretrained(path, use_fast=True)
+    tokenizer = AutoTokenizer.from_pretrained(name, use_fast=True)
+    tokenizer.save_pretrained(path)
+    return tokenizer
+
+
+def get_tokenizer():
+    """Get the tokenizer, loading it on first use.
+
+    :return: The tokenizer chosen with set_tokenizer.
+    :rtype: transformers.PreTrainedTokenizerFast
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                _tokenizer = load_tokenizer(tokenizer_name)
+    return _tokenizer
+
+
+def _encode(text):
+    tokens = _encoded.get(text)
+    if tokens is None:
+        tokens = _known_tokens.get(text, pop=True)
+        if tokens is None:
+            tokens = array('I', get_tokenizer().encode(text))
+        _encoded.put(text, tokens)
+    return tokens
+
+
+def encode_cache_size():
+    """Get how many token IDs are cached or remembered.
+
+    :return: The number of token IDs.
+    :rtype: int
+    """
+    return _encoded.tokens + _known_tokens.tokens
+
+
+def clear_encode_cache():
+    """Forget all cached and remembered token IDs."""
+    _encoded.clear()
+    _known_tokens.clear()
+
+
+def remember_tokens(text, tokens):
+    """Make known token IDs of a text available to encode without tokenizing it again.
+
+    :param text: The text.
+    :type text: str
+    :param tokens: The token IDs of the text for the current tokenizer.
+    :type tokens: list
+    """
+    _known_tokens.put(text, array('I', tokens))
+
+
+def run_off_loop(pool, fn, *args):
+    """Run a function on a worker pool, or on a thread if there is none.
+
+    :param pool: Anything with an async run(fn, *args) method like a WorkerPool, or None.
+    :type pool: WorkerPool
+    :param fn: The function to run.
+    :type fn: callable
+    :return: An awaitable of the function's result.
+    """
+    if pool is None:
+        return asyncio.to_thread(fn, *args)
+    return pool.run(fn, *args)
+
+
+def encode(text):
+    """Tokenize text, reusing the tokens of recently seen texts.
+
+    :param text: The text to tokenize.
+    :type text: str
+    :return: The token IDs of the text.
+    :rtype: list
+    """
+    return list(_encode(text))
+
+def count_tokens(*texts):
+    """Count the tokens of texts.
+
+    :return: The number of tokens of each text.
+    :rtype: list
+    """
+    return [len(_encode(i)) if i else 0 for i in texts]
 
-tokenizer = AutoTokenizer.from_pretrained('gpt2')
 
 TRIM_DIR_TOP = 0
 TRIM_DIR_BOTTOM = 1
@@ -16,17 +196,291 @@ INSERTION_TYPE_SENTENCE = 7
 INSERTION_TYPE_TOKEN = 8
 
 
+MINHASH_BINS = 64
+_MINHASH_BIN_BITS = 26  # 32-bit hashes, the top 6 bits pick the bin
+
+
+def minhash(text, shingle_size=3):
+    """Compute the one-permutation MinHash signature of a text's character shingles.
+
+    Every shingle is hashed once and the hash range is split into MINHASH_BINS bins
+    that each keep their smallest value. Empty bins borrow the value of the next
+    non-empty bin, offset by the distance, so short texts still get comparable signatures.
+
+    :param text: The text to compute the signature of.
+    :type text: str
+    :param shingle_size: The number of characters per shingle, defaults to 3.
+    :type shingle_size: int, optional
+    :return: The signature, one value per bin.
+    :rtype: tuple
+    """
+    if len(text) <= shingle_size:
+        shingles = {text}
+    else:
+        shingles = {text[i:i+shingle_size]
+                    for i in range(len(text) - shingle_size + 1)}
+    mask = (1 << _MINHASH_BIN_BITS) - 1
+    bins = [None] * MINHASH_BINS
+    for i in shingles:
+        h = (crc32(i.encode('utf-8')) * 0x9E3779B1) & 0xFFFFFFFF
+        b = h >> _MINHASH_BIN_BITS
+        if bins[b] is None or h & mask < bins[b]:
+            bins[b] = h & mask
+    signature = []
+    for b in range(MINHASH_BINS):
+        distance = 0
+        while bins[(b + distance) % MINHASH_BINS] is None:
+            distance += 1
+        signature.append(bins[(b + distance) % MINHASH_BINS] + (distance << _MINHASH_BIN_BITS))
+    return tuple(signature)
+
+
+class NearDuplicateIndex:
+    """A locality-sensitive hashing index over MinHash signatures."""
+
+    def __init__(self, threshold=0.8, bands=16):
+        """Initialize a NearDuplicateIndex.
+
+        :param threshold: The estimated Jaccard similarity above which two texts are near-duplicates, defaults to 0.8.
+        :type threshold: float, optional
+        :param bands: The number of LSH bands the signatures are split into, defaults to 16.
+        :type bands: int, optional
+        """
+        self.threshold = threshold
+        self.rows = MINHASH_BINS // bands
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = {}
+
+    def bands(self, signature):
+        return [signature[i*self.rows:(i+1)*self.rows] for i in range(len(self.buckets))]
+
+    def add(self, key, signature):
+        """Add a signature to the index.
+
+        :param key: The key the signature is stored under.
+        :type key: hashable
+        :param signature: The signature returned by minhash.
+        :type signature: tuple
+        """
+        self.signatures[key] = signature
+        for buckets, band in zip(self.buckets, self.bands(signature)):
+            buckets.setdefault(band, set()).add(key)
+
+    def remove(self, key):
+        """Remove a signature from the index if it is present.
+
+        :param key: The key the signature is stored under.
+        :type key: hashable
+        """
+        signature = self.signatures.pop(key, None)
+        if signature is None:
+            return
+        for buckets, band in zip(self.buckets, self.bands(signature)):
+            buckets[band].discard(key)
+            if not buckets[band]:
+                del buckets[band]
+
+    def query(self, signature):
+        """Find the keys of indexed signatures that are near-duplicates of a signature.
+
+        :param signature: The signature returned by minhash.
+        :type signature: tuple
+        :return: The keys of the near-duplicates.
+        :rtype: list
+        """
+        candidates = set()
+        for buckets, band in zip(self.buckets, self.bands(signature)):
+            candidates.update(buckets.get(band, ()))
+        return [i for i in candidates
+                if sum(a == b for a, b in zip(signature, self.signatures[i])) / len(signature) > self.threshold]
+
+
+class SpamFilter:
+    """Marks texts that are near-duplicates of a newer text, updated as texts are added and removed.
+
+    Every text is shingled once when it is added and checked against the index
+    instead of the whole window, so keeping the marks current is cheap.
+    """
+
+    def __init__(self, threshold=0.8):
+        """Initialize a SpamFilter.
+
+        :param threshold: The similarity above which a text counts as a duplicate, defaults to 0.8.
+        :type threshold: float, optional
+        """
+        self.index = NearDuplicateIndex(threshold)
+        # keys of the texts that have a newer near-duplicate
+        self.duplicates = set()
+
+    def add(self, key, text):
+        """Add a text, marking it or the older texts it duplicates.
+
+        :param key: The key of the text, newer texts have larger keys.
+        :type key: int
+        :param text: The text.
+        :type text: str
+        """
+        signature = minhash(text)
+        similar = self.index.query(signature)
+        if any(i > key for i in similar):
+            self.duplicates.add(key)
+        self.duplicates.update(i for i in similar if i < key)
+        self.index.add(key, signature)
+
+    def remove(self, key):
+        """Remove a text, unmarking the older texts that only duplicated it.
+
+        :param key: The key of the text.
+        :type key: int
+        """
+        signature = self.index.signatures.get(key)
+        if signature is None:
+            return
+        self.index.remove(key)
+        self.duplicates.discard(key)
+        for i in self.index.query(signature):
+            if i < key and i in self.duplicates and not any(j > i for j in self.index.query(self.index.signatures[i])):
+                self.duplicates.discard(i)
+
+
 def anti_spam(messages, threshold=0.8):
-    to_remove = []
-    for i in range(len(messages)):
-        for j in range(i+1, len(messages)):
-            if i != j:
-                if SequenceMatcher(None, messages[i].content, messages[j].content).ratio() > threshold:
-                    to_remove.append(j)
-    to_remove = list(set(to_remove))
-    messages = [messages[i]
-                for i in range(len(messages)) if i not in to_remove]
-    return messages, len(to_remove)
+    """Remove messages that are near-duplicates of an earlier message in the list.
+
+    :param messages: The messages to filter, anything with a content attribute.
+    :type messages: list
+    :param threshold: The similarity above which a message counts as a duplicate, defaults to 0.8.
+    :type threshold: float, optional
+    :return: The remaining messages and the number of removed messages.
+    :rtype: tuple
+    """
+    spam = SpamFilter(threshold)
+    # earlier messages get larger keys, so the later duplicates are the ones marked
+    for i, message in enumerate(messages):
+        spam.add(-i, message.content)
+    messages = [message for i, message in enumerate(messages) if -i not in spam.duplicates]
+    return messages, len(spam.duplicates)
+
+
+class KeywordIndex:
+    """An Aho-Corasick automaton that finds which of many keywords occur in a text in one pass."""
+
+    def __init__(self, keywords):
+        """Initialize a KeywordIndex.
+
+        :param keywords: The keywords to search for, matched as given.
+        :type keywords: iterable
+        """
+        # state 0 is the root, each state has its transitions, failure link and the keywords ending there
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        for keyword in keywords:
+            if not keyword:
+                continue
+            state = 0
+            for char in keyword:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state] += (keyword,)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.output[child] += self.output[self.fail[child]]
+
+    def search(self, text):
+        """Find the keywords that occur in a text.
+
+        :param text: The text to search.
+        :type text: str
+        :return: The keywords found.
+        :rtype: set
+        """
+        found = set()
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+# lorebooks by name, worker processes get a copy when they start so jobs only carry the names
+lorebooks = {}
+
+
+def register_lorebook(name, lorebook):
+    """Make a lorebook resident in the worker processes started after this.
+
+    A registered lorebook is sent to a worker process as its name and the
+    worker uses its own copy, instead of the whole lorebook with every job.
+
+    :param name: The name of the lorebook, e.g. the key of its character.
+    :type name: str
+    :param lorebook: The lorebook.
+    :type lorebook: Lorebook
+    :return: The lorebook.
+    :rtype: Lorebook
+    """
+    lorebook.name = name
+    lorebooks[name] = lorebook
+    return lorebook
+
+
+def resident_lorebook(name):
+    return lorebooks[name]
+
+
+class Lorebook:
+    """A collection of keyed ContextEntry objects with a keyword index that is built once."""
+
+    def __init__(self, entries=()):
+        """Initialize a Lorebook.
+
+        :param entries: The entries of the lorebook.
+        :type entries: iterable
+        """
+        self.name = None
+        self.entries = list(entries)
+        self.position = {entry: i for i, entry in enumerate(self.entries)}
+        self.forced = [i for i in self.entries if i.forced_activation]
+        self.keyed = {}
+        for entry in self.entries:
+            for key in entry.keys:
+                if key:
+                    self.keyed.setdefault(key.lower(), []).append(entry)
+        self.index = KeywordIndex(self.keyed)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __reduce_ex__(self, protocol):
+        if self.name is not None and lorebooks.get(self.name) is self:
+            return resident_lorebook, (self.name,)
+        return super().__reduce_ex__(protocol)
+
+    def lookup(self, text):
+        """Find the entries whose keys are found in a text, ignoring case.
+
+        :param text: The text to search.
+        :type text: str
+        :return: The entries activated by the text.
+        :rtype: list
+        """
+        return [entry for key in self.index.search(text.lower()) for entry in self.keyed[key]]
 
 
 class Preprocessor:
@@ -59,6 +513,11 @@ class ContextPreprocessor(Preprocessor):
         """
         self.token_budget = token_budget
         self.entries = []
+        self.lorebooks = []
+        # keyword index over self.entries, rebuilt when they change
+        self.entry_index = None
+        # tokens in the last built context
+        self.tokens_used = 0
 
     def add_entry(self, entry):
         """Add a ContextEntry to the ContextPreprocessor.
@@ -67,6 +526,15 @@ class ContextPreprocessor(Preprocessor):
         :type entry: ContextEntry
         """
         self.entries.append(entry)
+        self.entry_index = None
+
+    def add_lorebook(self, lorebook):
+        """Add a Lorebook whose entries can be activated by other entries.
+
+        :param lorebook: The Lorebook to add.
+        :type lorebook: Lorebook
+        """
+        self.lorebooks.append(lorebook)
 
     def del_entry(self, entry):
         """Delete a ContextEntry from the ContextPreprocessor.
@@ -75,6 +543,7 @@ class ContextPreprocessor(Preprocessor):
         :type entry: ContextEntry
         """
         self.entries.remove(entry)
+        self.entry_index = None
 
     # return true if key is found in an entry's text
     def key_lookup(self, entry_a, entry_b):
@@ -94,29 +563,73 @@ class ContextPreprocessor(Preprocessor):
                 return True
         return False
 
-    # recursive function that searches for other entries that are activated
+    def lookup(self, text):
+        """Find the entries and lorebook entries whose keys are found in a text.
+
+        :param text: The text to search.
+        :type text: str
+        :return: The entries activated by the text.
+        :rtype: list
+        """
+        if self.entry_index is None:
+            self.entry_index = Lorebook(self.entries)
+        entries = self.entry_index.lookup(text)
+        for lorebook in self.lorebooks:
+            entries.extend(lorebook.lookup(text))
+        return entries
+
+    # breadth-first search for entries activated by the given ones, each entry is visited once
+    def activate(self, entries, depth=4):
+        """Search for entries that are activated by the given entries, directly or through other activated entries.
+
+        :param entries: The entries to start the search from.
+        :type entries: list
+        :param depth: The maximum number of activation steps, defaults to 4.
+        :type depth: int, optional
+        :return: The activated entries in the order they were found, without the given entries.
+        :rtype: list
+        """
+        seen = set(entries)
+        cascaded_entries = []
+        frontier = list(entries)
+        for _ in range(depth):
+            found = []
+            for i in frontier:
+                for j in self.lookup(i.text):
+                    if j not in seen:
+                        seen.add(j)
+                        found.append(j)
+            cascaded_entries.extend(found)
+            frontier = found
+        return cascaded_entries
+
     def cascade_lookup(self, entry, nest=0):
         """Search for other entries that are activated by a given entry.
 
-        :param entry: The entry to recursively search for other entries in.
+        :param entry: The entry to search for other entries in.
         :type entry: ContextEntry
-        :param nest: The maximum amount of recursion to perform, defaults to 0.
+        :param nest: The recursion depth already used, at most 4 steps are taken, defaults to 0.
         :type nest: int, optional
         :return: A list of other entries that are activated by the given entry.
         :rtype: list
         """
-        cascaded_entries = []
-        if nest > 3:
-            return []
-        for i in self.entries:
-            if self.key_lookup(entry, i):
-                # check if i activates entry to prevent infinite loop
-                if self.key_lookup(i, entry):
-                    cascaded_entries.append(i)
-                    continue
-                for j in self.cascade_lookup(i, nest+1):
-                    cascaded_entries.append(j)
-        return cascaded_entries
+        return self.activate([entry], 4 - nest)
+
+    def order(self, entry):
+        """Get the sort key placing an entry among the others, highest insertion order first.
+
+        Lorebook entries of the same insertion order keep the order of their lorebook
+        instead of the order their keywords happened to be found in.
+
+        :param entry: The entry.
+        :type entry: ContextEntry
+        :return: The sort key.
+        :rtype: tuple
+        """
+        for idx, lorebook in enumerate(self.lorebooks):
+            if entry in lorebook.position:
+                return -entry.insertion_order, idx, lorebook.position[entry]
+        return -entry.insertion_order, -1, 0
 
     # handles cases where elements are added to the end of a list using list.insert
     def ordinal_pos(self, position, length):
@@ -134,43 +647,30 @@ class ContextPreprocessor(Preprocessor):
         """
         # sort self.entries by insertion_order
         self.entries.sort(key=lambda x: x.insertion_order, reverse=True)
-        activated_entries = []
-
-        # Get entries activated by default
-        for i in self.entries:
-            if i.forced_activation:
-                if i.cascading_activation:
-                    for j in self.cascade_lookup(i):
-                        activated_entries.append(j)
-                    activated_entries.append(i)
-                else:
-                    activated_entries.append(i)
-            if i.insertion_position > 0 or i.insertion_position < 0:
-                if i.reserved_tokens == 0:
-                    i.reserved_tokens = len(tokenizer.encode(i.text))
 
-        activated_entries = list(set(activated_entries))
+        # Get entries activated by default, then the ones they cascade to
+        activated_entries = [i for i in self.entries if i.forced_activation]
+        for lorebook in self.lorebooks:
+            activated_entries.extend(lorebook.forced)
+        activated_entries = list(dict.fromkeys(activated_entries))
+        activated_entries.extend(self.activate([i for i in activated_entries if i.cascading_activation]))
+
         # sort activated_entries by insertion_order
-        activated_entries.sort(key=lambda x: x.insertion_order, reverse=True)
+        activated_entries.sort(key=self.order)
+
+        # reserved tokens are taken out before any text is placed, so entries placed
+        # earlier, like lore, cannot use up what the conversation reserved
+        reservations = {i: min(len(i.tokens), i.reserved_tokens) for i in activated_entries if i.reserved_tokens > 0}
+        budget -= sum(reservations.values())
 
         newctx = []
+        self.tokens_used = 0
         for i in activated_entries:
-            reserved = 0
-            if i.reserved_tokens > 0:
-                len_tokens = len(tokenizer.encode(i.text))
-                if len_tokens < i.reserved_tokens:
-                    budget -= len_tokens
-                else:
-                    budget -= i.reserved_tokens
-                if len_tokens > i.reserved_tokens:
-                    reserved = i.reserved_tokens
-                else:
-                    reserved = len_tokens
-
-            text = i.get_text(budget + reserved, self.token_budget)
-            ctxtext = text.splitlines(keepends=False)
-            trimmed_tokenized = tokenizer.encode(text)
+            reserved = reservations.get(i, 0)
+            trimmed_tokenized = i.trim(max(0, budget + reserved), self.token_budget)
+            ctxtext = get_tokenizer().decode(trimmed_tokenized).splitlines(keepends=False)
             budget -= len(trimmed_tokenized) - reserved
+            self.tokens_used += len(trimmed_tokenized)
             ctxinsertion = i.insertion_position
 
             before = []
@@ -198,6 +698,20 @@ class ContextPreprocessor(Preprocessor):
                 newctx.append(after[aIdx])
         return '\n'.join(newctx)
 
+    async def context_async(self, budget=1024, pool=None):
+        """Like context, but built off the event loop.
+
+        :param budget: The maximum number of tokens that can be used in the context, defaults to 1024.
+        :type budget: int, optional
+        :param pool: The pool to build on, a thread if not given.
+        :type pool: WorkerPool, optional
+        :return: The built context.
+        :rtype: str
+        """
+        # a worker process builds on a copy, so tokens_used is handed back with the context
+        context, self.tokens_used = await run_off_loop(pool, _build_context, self, budget)
+        return context
+
     def __call__(self, context: str, is_respond: bool, name: str) -> str:
         """Build the context from the ContextPreprocessor's entries.
 
@@ -223,38 +737,51 @@ class ContextPreprocessor(Preprocessor):
         return constructed_context
 
 
+def _build_context(preprocessor, budget):
+    return preprocessor.context(budget), preprocessor.tokens_used
+
+
+def split_lore(lorebook, text):
+    """Find the lorebook entries of a context, split into the ones that are always in it and the ones a text activates.
+
+    Forced entries and the entries they cascade to are the same for every context,
+    the others change with the text.
+
+    :param lorebook: The lorebook.
+    :type lorebook: Lorebook
+    :param text: The text activating entries, e.g. the conversation.
+    :type text: str
+    :return: The text of the fixed entries and the text of the activated ones, each sorted by insertion order.
+    :rtype: tuple
+    """
+    contextmgr = ContextPreprocessor()
+    contextmgr.add_lorebook(lorebook)
+    fixed = list(dict.fromkeys(lorebook.forced + contextmgr.activate(
+        [i for i in lorebook.forced if i.cascading_activation])))
+    activated = [i for i in contextmgr.activate([ContextEntry(text=text, cascading_activation=True)])
+                 if i not in set(fixed)]
+    return tuple(''.join(i.text for i in sorted(entries, key=contextmgr.order))
+                 for entries in (fixed, activated))
+
+
 def trim_newlines(tokens, trim_dir, limit):
     if (trim_dir == TRIM_DIR_NONE) or (len(tokens) <= limit):
         return tokens
 
-    lines = tokenizer.decode(tokens).split('\n')
-    start, end, step = 0, 0, 0
+    lines = get_tokenizer().decode(tokens).split('\n')
     if trim_dir == TRIM_DIR_TOP:
-        start = len(lines) - 1
-        end = -1
-        step = -1
+        segments = [encode('\n' + line) for line in reversed(lines)]
     elif trim_dir == TRIM_DIR_BOTTOM:
-        start = 0
-        end = len(lines)
-        step = 1
-
-    acc_tokens = []
-
-    for idx in range(start, end, step):
-        line = lines[idx]
-        if trim_dir == TRIM_DIR_TOP:
-            line = '\n' + line
-        elif trim_dir == TRIM_DIR_BOTTOM:
-            line = line + '\n'
-        new_tokens = tokenizer.encode(line)
-        if len(new_tokens) + len(acc_tokens) > limit:
-            return acc_tokens
-        else:
-            if trim_dir == TRIM_DIR_TOP:
-                acc_tokens = new_tokens + acc_tokens
-            elif trim_dir == TRIM_DIR_BOTTOM:
-                acc_tokens = acc_tokens + new_tokens
-    return acc_tokens
+        segments = [encode(line + '\n') for line in lines]
+    else:
+        return tokens
+
+    # number of lines, counted from the kept end, whose tokens fit in the limit
+    kept = bisect_right(list(accumulate(len(i) for i in segments)), limit)
+    segments = segments[:kept]
+    if trim_dir == TRIM_DIR_TOP:
+        segments.reverse()
+    return list(chain.from_iterable(segments))
 
 
 def split_into_sentences(str):
@@ -262,56 +789,65 @@ def split_into_sentences(str):
     return re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?|\!)\s', str)
 
 
+def sentence_spans(text):
+    """Split text into sentences and return their offsets.
+
+    Sentences are separated by exactly one whitespace character, which always
+    directly follows the punctuation ending the previous sentence.
+
+    :param text: The text to split.
+    :type text: str
+    :return: A list of (start, end) offsets of each sentence in the text.
+    :rtype: list
+    """
+    spans = []
+    start = 0
+    for sentence in split_into_sentences(text):
+        spans.append((start, start + len(sentence)))
+        start += len(sentence) + 1
+    return spans
+
+
+# Sentence boundaries sit between punctuation and whitespace, which the GPT-2
+# pre-tokenizer never merges, so the token count of a span of sentences is the
+# sum of the counts of its pieces and each piece only has to be tokenized once.
 def trim_sentences(tokens, trim_dir, limit):
     if (trim_dir == TRIM_DIR_NONE) or (len(tokens) <= limit):
         return tokens
 
-    text = tokenizer.decode(tokens)
-    sentences = split_into_sentences(text)
-
-    start, end, step = 0, 0, 0
-    text_begin, text_end = 0, 0
-    sentence_idx, last_sentence_idx = 0, 0
+    text = get_tokenizer().decode(tokens)
+    spans = sentence_spans(text)
 
     if trim_dir == TRIM_DIR_TOP:
-        start = len(sentences) - 1
-        end = -1
-        step = -1
-        text_begin = 0
+        # tokens of text[spans[idx][1]:], i.e. everything after the current sentence
+        suffix_count = 0
         text_end = len(text)
-    elif trim_dir == TRIM_DIR_BOTTOM:
-        start = 0
-        end = len(sentences)
-        step = 1
-        text_begin = 0
-        text_end = len(text)
-    else:
-        return tokens
-
-    for idx in range(start, end, step):
-        sentence = sentences[idx]
-        if trim_dir == TRIM_DIR_TOP:
-            sentence_idx = text.rindex(sentence) + text_begin
+        for idx in range(len(spans) - 1, -1, -1):
+            sentence_idx, sentence_end = spans[idx]
             if (sentence_idx > 0) and (sentence_idx < len(text)) and (text[sentence_idx] == ' '):
                 sentence_idx -= 1
-            to_tokenize = text[sentence_idx:]
-            token_count = len(tokenizer.encode(to_tokenize))
+            token_count = len(encode(text[sentence_idx:sentence_end])) + suffix_count
             if token_count >= limit:
-                to_encode = text[text_end:]
-                return tokenizer.encode(to_encode)
+                return encode(text[text_end:])
             text_end = sentence_idx - 1
-        elif trim_dir == TRIM_DIR_BOTTOM:
-            sentence_idx = text.index(sentence) + text_begin
-            sentence_end = sentence_idx + len(sentence)
-            if (sentence_end < text_end) and (text[sentence_end:sentence_end+1] == '\n'):
+            if idx > 0:
+                # the separator is tokenized together with the sentence following it
+                suffix_count += len(encode(text[spans[idx - 1][1]:sentence_end]))
+    elif trim_dir == TRIM_DIR_BOTTOM:
+        # tokens of text[0:spans[idx][1]], i.e. everything up to the end of the current sentence
+        prefix_count = 0
+        last_sentence_idx = 0
+        segment_start = 0
+        for sentence_idx, sentence_end in spans:
+            prefix_count += len(encode(text[segment_start:sentence_end]))
+            segment_start = sentence_end
+            token_count = prefix_count
+            if (sentence_end < len(text)) and (text[sentence_end:sentence_end+1] == '\n'):
                 sentence_end += 1
-            to_tokenize = text[0:sentence_end]
-            token_count = len(tokenizer.encode(to_tokenize))
+                token_count += len(encode('\n'))
             if token_count >= limit:
-                to_encode = text[0:last_sentence_idx]
-                return tokenizer.encode(to_encode)
+                return encode(text[0:last_sentence_idx])
             last_sentence_idx = sentence_end
-            text_begin += len(sentence)
     return tokens
 
 
@@ -345,10 +881,26 @@ class ContextEntry:
         # when activated, this context entry will search for other entries and activate them if found
         self.cascading_activation = cascading_activation
 
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+        self._tokens = None
+
+    # tokenized lazily and kept until the text changes
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            self._tokens = encode(self._text)
+        return self._tokens
+
     # max_length is in tokens
     def trim(self, max_length, token_budget):
         target = 0
-        tokens = tokenizer.encode(self.text)
+        tokens = list(self.tokens)
         num_tokens = len(tokens)
         projected = max_length - num_tokens
         if projected > token_budget:
@@ -366,4 +918,92 @@ class ContextEntry:
         return tokens
 
     def get_text(self, max_length, token_budget):
-        return tokenizer.decode(self.trim(max_length, token_budget))
+        return get_tokenizer().decode(self.trim(max_length, token_budget))
+
+
+class StableContext:
+    """Builds contexts whose beginning stays the same from one turn to the next.
+
+    Lines are only appended until the budget runs out, then a large chunk of the
+    oldest lines is dropped at once. Every piece is tokenized on its own, so the
+    token IDs of the kept prefix never change and a backend can reuse its cache for them.
+    """
+
+    def __init__(self, token_budget=1024, drop_ratio=0.5):
+        """Initialize a StableContext.
+
+        :param token_budget: The maximum number of tokens that can be used in the context, defaults to 1024.
+        :type token_budget: int, optional
+        :param drop_ratio: The share of the conversation budget freed when lines have to be dropped, defaults to 0.5.
+        :type drop_ratio: float, optional
+        """
+        self.token_budget = token_budget
+        self.drop_ratio = drop_ratio
+        self.start = None  # key of the oldest line kept
+
+    def build(self, header, lines, suffix, lorebook=None):
+        """Build the context.
+
+        :param header: The text placed before the conversation, e.g. the prompt.
+        :type header: str
+        :param lines: The conversation as (key, line) pairs, oldest first, with increasing keys.
+        :type lines: list
+        :param suffix: The text placed after the conversation.
+        :type suffix: str
+        :param lorebook: A lorebook whose forced entries are added to the header. The entries the conversation
+            activates are placed after it, so a change in them does not change the beginning of the context.
+        :type lorebook: Lorebook, optional
+        :return: The context and its token IDs, or None if the header and suffix alone exceed the budget.
+        :rtype: tuple
+        """
+        if lorebook is not None:
+            fixed, activated = split_lore(lorebook, '\n'.join(line for _, line in lines))
+            header += fixed
+            if activated:
+                suffix = '\n' + activated.rstrip('\n') + suffix
+        header_tokens = encode(header)
+        suffix_tokens = encode(suffix)
+        budget = self.token_budget - len(header_tokens) - len(suffix_tokens)
+        if budget <= 0:
+            return None
+        drop = 0
+        if self.start is not None:
+            lines = [i for i in lines if i[0] >= self.start]
+            if lines and lines[0][0] != self.start:
+                # the first kept line left the window, move the start ahead by a chunk so it holds for a while
+                drop = int(len(lines) * self.drop_ratio)
+
+        # the first line has no newline of its own, so its tokens change when it becomes the first
+        pieces = [encode(line if idx == 0 else '\n' + line)
+                  for idx, (_, line) in enumerate(lines)]
+        total = sum(len(i) for i in pieces[drop:])
+        if total > budget:
+            target = budget * (1 - self.drop_ratio)
+            while drop < len(lines) and total > target:
+                total -= len(pieces[drop])
+                drop += 1
+        if drop:
+            lines = lines[drop:]
+            pieces = [encode(lines[0][1])] + pieces[drop+1:] if lines else []
+        self.start = lines[0][0] if lines else None
+
+        tokens = list(chain(header_tokens, *pieces, suffix_tokens))
+        text = header + '\n'.join(line for _, line in lines) + suffix
+        return text, tokens
+
+    async def build_async(self, header, lines, suffix, pool=None, lorebook=None):
+        """Like build, but run off the event loop.
+
+        :param pool: The pool to build on, a thread if not given.
+        :type pool: WorkerPool, optional
+        :return: The context and its token IDs, or None if the header and suffix alone exceed the budget.
+        :rtype: tuple
+        """
+        # built on a copy so a reply that is cancelled midway cannot leave the window half updated
+        self.start, built = await run_off_loop(pool, _build_stable, copy.copy(self), header, lines, suffix, lorebook)
+        return built
+
+
+def _build_stable(window, header, lines, suffix, lorebook=None):
+    built = window.build(header, lines, suffix, lorebook)
+    return window.start, built
@@ -0,0 +1,81 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import utils
+
+
+def init_process(tokenizer_name, lorebooks):
+    """Set up a worker process like the process that started it.
+
+    :param tokenizer_name: The name of the tokenizer.
+    :type tokenizer_name: str
+    :param lorebooks: The entries of the registered lorebooks by name.
+    :type lorebooks: dict
+    """
+    utils.set_tokenizer(tokenizer_name)
+    for name, entries in lorebooks.items():
+        utils.register_lorebook(name, utils.Lorebook(entries))
+
+
+class WorkerPool:
+    """Runs CPU-bound work like context building off the event loop."""
+
+    def __init__(self, size=None, queue=64, processes=False):
+        """Initialize a WorkerPool.
+
+        :param size: How many jobs run at once, the number of CPUs if not given.
+        :type size: int, optional
+        :param queue: How many more jobs may wait for a worker before callers have to wait to submit, defaults to 64.
+        :type queue: int, optional
+        :param processes: Whether to run jobs in worker processes instead of threads, defaults to False.
+            Threads keep the event loop responsive, processes also build contexts in parallel
+            on several cores, but every job's arguments and result are copied between processes.
+            Lorebooks registered before the start are copied once and stay in the processes.
+        :type processes: bool, optional
+        """
+        self.size = size or os.cpu_count() or 1
+        self.queue = queue
+        self.processes = processes
+        self.executor = None
+        self.slots = None
+
+    def start(self):
+        """Start the workers."""
+        if self.executor is None:
+            if self.processes:
+                # spawn instead of fork, the event loop and tokenizer threads do not survive a fork
+                lorebooks = {name: lorebook.entries for name, lorebook in utils.lorebooks.items()}
+                self.executor = ProcessPoolExecutor(self.size, mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=init_process, initargs=(utils.tokenizer_name, lorebooks))
+            else:
+                self.executor = ThreadPoolExecutor(
+                    self.size, thread_name_prefix='worker')
+            self.slots = asyncio.Semaphore(self.size + self.queue)
+
+    def close(self):
+        """Stop the workers, letting running jobs finish."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def run(self, fn, *args):
+        """Run a function on a worker.
+
+        The job keeps its slot until it has finished, even if the caller is cancelled,
+        so a cancelled reply cannot pile more work onto busy workers.
+
+        :param fn: The function to run, it has to be picklable when running in processes.
+        :type fn: callable
+        :return: The result of the function.
+        """
+        if self.executor is None:
+            self.start()
+        async with self.slots:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                await asyncio.wait([future])
+                raise